@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Admission Control
+Caps connections (total and per IP) and concurrent nickname handshakes so a
+reconnect storm is turned away cheaply, with a retry hint, instead of every
+client running the full join sequence at once.
+"""
+
+import asyncio
+import json
+import os
+import time
+
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", 500))
+MAX_CONNECTIONS_PER_IP = int(os.environ.get("MAX_CONNECTIONS_PER_IP", 8))
+MAX_CONCURRENT_HANDSHAKES = int(os.environ.get("MAX_CONCURRENT_HANDSHAKES", 16))
+HANDSHAKE_WAIT = float(os.environ.get("HANDSHAKE_WAIT", 2.0))  # seconds
+
+RETRY_AFTER_BASE = 2  # seconds
+RETRY_AFTER_MAX = 60
+REJECTION_WINDOW = 10  # seconds
+
+# "Try Again Later" - the server is overloaded, not broken
+CLOSE_TRY_AGAIN_LATER = 1013
+
+
+class AdmissionController:
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_per_ip=MAX_CONNECTIONS_PER_IP,
+                 max_handshakes=MAX_CONCURRENT_HANDSHAKES, handshake_wait=HANDSHAKE_WAIT):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.max_handshakes = max_handshakes
+        self.handshake_wait = handshake_wait
+
+        self.connections = 0
+        self.connections_per_ip = {}
+        self._handshake_slots = None  # Semaphore, created on the running loop
+
+        # Rejections in the current window; the retry hint grows with them
+        self.window_start = time.monotonic()
+        self.recent_rejections = 0
+
+    def admit(self, ip):
+        """Reserve a connection slot; returns None or a close reason to reject with"""
+        if self.connections >= self.max_connections:
+            return self.reject("server_full")
+        if self.connections_per_ip.get(ip, 0) >= self.max_per_ip:
+            return self.reject("too_many_connections")
+
+        self.connections += 1
+        self.connections_per_ip[ip] = self.connections_per_ip.get(ip, 0) + 1
+        return None
+
+    def release(self, ip):
+        """Free a slot reserved by admit()"""
+        self.connections -= 1
+        remaining = self.connections_per_ip.get(ip, 0) - 1
+        if remaining > 0:
+            self.connections_per_ip[ip] = remaining
+        else:
+            self.connections_per_ip.pop(ip, None)
+
+    async def begin_handshake(self):
+        """Wait briefly for a handshake slot; returns None or a close reason"""
+        if self._handshake_slots is None:
+            self._handshake_slots = asyncio.Semaphore(self.max_handshakes)
+        try:
+            await asyncio.wait_for(self._handshake_slots.acquire(), self.handshake_wait)
+        except asyncio.TimeoutError:
+            return self.reject("server_busy")
+        return None
+
+    def end_handshake(self):
+        self._handshake_slots.release()
+
+    def retry_after(self):
+        """Seconds a rejected client should wait; grows with rejection rate"""
+        now = time.monotonic()
+        if now - self.window_start > REJECTION_WINDOW:
+            self.window_start = now
+            self.recent_rejections = 0
+        load = 1 + self.recent_rejections // max(1, self.max_handshakes)
+        return min(RETRY_AFTER_MAX, RETRY_AFTER_BASE * load)
+
+    def reject(self, reason):
+        retry_after = self.retry_after()
+        self.recent_rejections += 1
+        # Close reasons are limited to 123 bytes; this stays well under
+        return json.dumps({"reason": reason, "retry_after": retry_after})
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+"""
+Benchmark Harness
+Micro-benchmarks for the chat server's hot paths.
+
+Usage: python benchmark.py <scenario> [options]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import zlib
+from datetime import datetime
+
+from crypto_pool import CryptoPool
+from frame_codec import FrameEncoder, SUPPORTED_ENCODINGS, decompress_frame
+from room_keys import RoomKeyManager
+
+
+def make_nicknames(count):
+    """Generate plausible nicknames"""
+    words = ["fox", "owl", "pixel", "nova", "echo", "byte", "luna", "zed"]
+    return [f"{random.choice(words)}_{i}" for i in range(count)]
+
+
+def make_chat_frame(nickname, content):
+    return json.dumps({
+        "type": "chat_message",
+        "nickname": nickname,
+        "content": content,
+        "timestamp": datetime.now().isoformat()
+    })
+
+
+def make_workload(frames, users):
+    """A broadcast stream: mostly small chat frames, some large ones"""
+    nicknames = make_nicknames(users)
+    phrases = ["hey", "anyone up for a match?", "gg", "brb", "lol that was close",
+               "who wants to queue", "nice one", "ok see you later"]
+    workload = []
+    for i in range(frames):
+        roll = random.random()
+        if roll < 0.05:
+            workload.append(json.dumps({"type": "user_list", "users": nicknames}))
+        elif roll < 0.08:
+            batch = [json.loads(make_chat_frame(random.choice(nicknames), random.choice(phrases)))
+                     for _ in range(30)]
+            workload.append(json.dumps({"type": "history", "messages": batch}))
+        else:
+            workload.append(make_chat_frame(random.choice(nicknames), random.choice(phrases)))
+    return workload
+
+
+def bench_compression(args):
+    """Compare per-connection permessage-deflate with selective shared compression"""
+    random.seed(args.seed)
+    workload = make_workload(args.frames, args.users)
+    raw_bytes = sum(len(frame) for frame in workload) * args.recipients
+
+    results = [("none", raw_bytes, 0.0, 0)]
+
+    # permessage-deflate: one compressor per connection, every frame deflated
+    start = time.perf_counter()
+    compressors = [zlib.compressobj(6, zlib.DEFLATED, -15) for _ in range(args.recipients)]
+    total = 0
+    calls = 0
+    for frame in workload:
+        data = frame.encode("utf-8")
+        for compressor in compressors:
+            total += len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+            calls += 1
+    results.append(("permessage-deflate", total, time.perf_counter() - start, calls))
+
+    # Selective: only frames above threshold, compressed once per broadcast
+    for encoding in SUPPORTED_ENCODINGS:
+        encoder = FrameEncoder(threshold=args.threshold)
+        start = time.perf_counter()
+        for frame in workload:
+            cache = {}
+            for _ in range(args.recipients):
+                encoder.encode(frame, encoding, cache)
+        elapsed = time.perf_counter() - start
+        results.append((f"selective/{encoding}", encoder.stats["bytes_out"], elapsed,
+                        encoder.stats["compress_calls"]))
+
+        # Sanity check: every compressed frame round-trips
+        for frame in workload:
+            encoded = encoder.encode(frame, encoding)
+            if isinstance(encoded, bytes):
+                assert decompress_frame(encoded, encoding) == frame
+
+    print(f"{args.frames} broadcasts x {args.recipients} recipients, "
+          f"{args.users} users, threshold {args.threshold} bytes")
+    print(f"{'mode':<28}{'bytes':>14}{'ratio':>8}{'cpu ms':>10}{'deflates':>10}")
+    for name, size, elapsed, calls in results:
+        print(f"{name:<28}{size:>14}{size / raw_bytes:>8.2f}{elapsed * 1000:>10.1f}{calls:>10}")
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_handshake(port, timeout=30.0):
+    """Retry connecting until the server completes a WebSocket handshake"""
+    import websockets
+
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            async with websockets.connect(f"ws://127.0.0.1:{port}"):
+                return True
+        except (OSError, websockets.exceptions.InvalidHandshake):
+            await asyncio.sleep(0.005)
+    return False
+
+
+async def wait_for_first_reply(port, process, timeout=30.0):
+    """Retry until the server answers a set_nickname; False if it errors or exits"""
+    import websockets
+
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline and process.poll() is None:
+        try:
+            async with websockets.connect(f"ws://127.0.0.1:{port}") as ws:
+                await ws.send(json.dumps({"type": "set_nickname", "nickname": "startup"}))
+                reply = json.loads(await ws.recv())
+                return reply.get("type") == "nickname_set"
+        except (OSError, websockets.exceptions.InvalidHandshake):
+            await asyncio.sleep(0.005)
+    return False
+
+
+def launch_server(port, **env_overrides):
+    """Start backend/server.py in cloud mode on the given port"""
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    env = dict(os.environ, RENDER="1", PORT=str(port), **env_overrides)
+    return subprocess.Popen([sys.executable, server_path], env=env, cwd=os.path.dirname(server_path),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def bench_startup(args):
+    """Time from process exec to the first answered message (cloud mode)"""
+    samples = []
+    for _ in range(args.runs):
+        port = free_port()
+        start = time.perf_counter()
+        process = launch_server(port)
+        try:
+            if asyncio.run(wait_for_first_reply(port, process)):
+                samples.append(time.perf_counter() - start)
+        finally:
+            process.terminate()
+            process.wait()
+
+    if not samples:
+        print("Server never answered a message")
+        return
+    print(f"{len(samples)} cold starts, exec -> first nickname_set reply")
+    print(f"median {statistics.median(samples) * 1000:.1f} ms, "
+          f"min {min(samples) * 1000:.1f} ms, max {max(samples) * 1000:.1f} ms")
+
+
+async def simulate_call_setup(participants, window):
+    """Run a mesh call setup with trickled ICE and record what gets delivered"""
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from voice_sessions import VoiceSessionManager
+
+    delivered = []  # (time, message)
+
+    async def send(client_id, message):
+        delivered.append((time.perf_counter(), message))
+
+    manager = VoiceSessionManager(send, mesh_limit=participants, batch_window=window)
+    nicknames = {i: f"peer_{i}" for i in range(participants)}
+    for client_id, nickname in nicknames.items():
+        await manager.join(client_id, nickname, "general")
+    delivered.clear()
+
+    # Gathering timeline per peer connection (seconds): host candidates
+    # immediately, server-reflexive after a STUN round trip, relay last
+    timeline = [0.0, 0.0005, 0.001, 0.020, 0.021, 0.045, 0.046, 0.050]
+    sent_at = {}
+
+    async def trickle(sender_id, target_id):
+        start = time.perf_counter()
+        for index, offset in enumerate(timeline):
+            await asyncio.sleep(max(0.0, start + offset - time.perf_counter()))
+            last = index == len(timeline) - 1
+            candidate = None if last else {"candidate": f"{sender_id}>{target_id}#{index}"}
+            key = (sender_id, target_id, index)
+            sent_at[key] = time.perf_counter()
+            await manager.relay_signal(sender_id, {
+                "type": "voice_ice_candidate",
+                "to": nicknames[target_id],
+                "candidate": candidate or {"candidate": "", "key": list(key)}
+            })
+
+    await asyncio.gather(*(trickle(a, b) for a in nicknames for b in nicknames if a != b))
+    await asyncio.sleep(window * 2 + 0.01)
+
+    # Delivery delay per candidate
+    delays = []
+    for delivered_at, message in delivered:
+        for entry in message["candidates"]:
+            candidate = entry["candidate"]
+            if candidate.get("key"):
+                key = tuple(candidate["key"])
+            else:
+                sender, rest = candidate["candidate"].split(">")
+                target, index = rest.split("#")
+                key = (int(sender), int(target), int(index))
+            delays.append(delivered_at - sent_at[key])
+    return manager.stats, delays
+
+
+def bench_ice(args):
+    """Frames per call setup with and without ICE candidate coalescing"""
+    print(f"Mesh call setup, {args.participants} participants, trickled ICE")
+    print(f"{'window ms':<12}{'candidates':>12}{'frames':>8}{'mean delay ms':>16}{'max delay ms':>15}")
+    for window in (0.0, args.window):
+        stats, delays = asyncio.run(simulate_call_setup(args.participants, window))
+        print(f"{window * 1000:<12.1f}{stats['candidates']:>12}{stats['frames']:>8}"
+              f"{statistics.mean(delays) * 1000:>16.2f}{max(delays) * 1000:>15.2f}")
+
+
+async def check_voice_topology(mesh_limit):
+    """Check the mesh cap without a relay, then drive mesh -> hub -> mesh with the
+    loopback relay; returns the steps checked"""
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from voice_sessions import VoiceSessionManager, LoopbackRelayPeer, RELAY_NICKNAME
+
+    inbox = {}  # client_id -> messages received
+
+    async def send(client_id, message):
+        inbox.setdefault(client_id, []).append(message)
+
+    def last_session(client_id):
+        return [m for m in inbox[client_id] if m["type"] == "voice_session"][-1]
+
+    steps = []
+
+    # No relay configured: the call stays in mesh and is capped there
+    manager = VoiceSessionManager(send, mesh_limit=mesh_limit, batch_window=0)
+    for client_id in range(mesh_limit):
+        await manager.join(client_id, f"peer_{client_id}", "general")
+    assert not await manager.join(mesh_limit, f"peer_{mesh_limit}", "general")
+    assert inbox[mesh_limit][-1]["type"] == "voice_join_rejected"
+    assert manager.rooms["general"].topology == "mesh"
+    steps.append(f"no relay: participant {mesh_limit + 1} rejected, still mesh")
+
+    inbox.clear()
+    manager = VoiceSessionManager(send, relay_factory=LoopbackRelayPeer, mesh_limit=mesh_limit, batch_window=0)
+    for client_id in range(mesh_limit):
+        await manager.join(client_id, f"peer_{client_id}", "general")
+    assert all(last_session(i)["topology"] == "mesh" for i in range(mesh_limit))
+    steps.append(f"{mesh_limit} participants: mesh")
+
+    await manager.join(mesh_limit, f"peer_{mesh_limit}", "general")
+    room = manager.rooms["general"]
+    assert isinstance(room.relay, LoopbackRelayPeer)
+    assert all(last_session(i)["topology"] == "hub" for i in range(mesh_limit + 1))
+    assert all(last_session(i)["relay"] == RELAY_NICKNAME for i in range(mesh_limit + 1))
+    steps.append(f"{mesh_limit + 1} participants: hub, everyone told to renegotiate")
+
+    await manager.relay_signal(0, {"type": "voice_offer", "to": RELAY_NICKNAME, "offer": {"sdp": "v=0 test"}})
+    answer = inbox[0][-1]
+    assert answer["type"] == "voice_answer" and answer["from"] == RELAY_NICKNAME
+    assert answer["answer"] == {"sdp": "v=0 test"}
+    await manager.relay_signal(0, {"type": "voice_ice_candidate", "to": RELAY_NICKNAME,
+                                   "candidate": {"candidate": "host 1"}})
+    assert room.relay.candidates[0][-1] == {"candidate": "host 1"}
+    steps.append("offer -> loopback answer, candidates reach the relay")
+
+    await manager.leave(mesh_limit)
+    assert room.topology == "mesh" and room.relay is None
+    assert all(last_session(i)["topology"] == "mesh" for i in range(mesh_limit))
+    steps.append(f"back to {mesh_limit} participants: mesh, relay closed")
+    return steps
+
+
+def bench_voice(args):
+    """Self-check of the mesh/hub switch using the loopback relay"""
+    for step in asyncio.run(check_voice_topology(args.participants)):
+        print(f"ok  {step}")
+
+
+async def run_chatty_clients(port, clients, messages):
+    """Each client fires a burst of chat messages; wait until all are delivered"""
+    import websockets
+
+    url = f"ws://127.0.0.1:{port}/?batch=1"
+    sockets = [await websockets.connect(url) for _ in range(clients)]
+    for i, ws in enumerate(sockets):
+        await ws.send(json.dumps({"type": "set_nickname", "nickname": f"load_{i}"}))
+        joined = False
+        while not joined:
+            data = json.loads(await ws.recv())
+            batch = data["messages"] if data.get("type") == "batch" else [data]
+            joined = any(message.get("type") == "user_list" for message in batch)
+    await asyncio.sleep(0.5)  # Let join broadcasts settle
+
+    expected = clients * messages
+    frames = [0] * clients
+
+    async def receive(index, ws):
+        seen = 0
+        while seen < expected:
+            frames[index] += 1
+            data = json.loads(await ws.recv())
+            batch = data["messages"] if data.get("type") == "batch" else [data]
+            seen += sum(1 for message in batch if message.get("type") == "chat_message")
+
+    async def burst(index, ws):
+        for n in range(messages):
+            await ws.send(json.dumps({"type": "chat_message", "content": f"{index}:{n}"}))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(receive(i, ws) for i, ws in enumerate(sockets)),
+                         *(burst(i, ws) for i, ws in enumerate(sockets)))
+    elapsed = time.perf_counter() - start
+    for ws in sockets:
+        await ws.close()
+    return elapsed, sum(frames)
+
+
+def bench_pipeline(args):
+    """Chatty-client throughput with and without inbound batching.
+
+    The server's rate limiter applies; keep --messages within its budget.
+    """
+    print(f"{args.participants} chatty clients x {args.messages} messages, all-to-all broadcast")
+    print(f"{'max batch':<12}{'seconds':>10}{'msgs/s':>12}{'frames recv':>14}")
+    for batch_size in (1, 32):
+        port = free_port()
+        # All load clients share one IP; lift the per-IP cap for them
+        process = launch_server(port, MAX_INBOUND_BATCH=str(batch_size),
+                                MAX_CONNECTIONS_PER_IP=str(args.participants + 1))
+        try:
+            asyncio.run(wait_for_handshake(port))
+            elapsed, frames = asyncio.run(run_chatty_clients(port, args.participants, args.messages))
+        finally:
+            process.terminate()
+            process.wait()
+        delivered = args.participants * args.participants * args.messages
+        print(f"{batch_size:<12}{elapsed:>10.2f}{delivered / elapsed:>12.0f}{frames:>14}")
+
+
+def verify_hmac(encrypted_content, signature, key):
+    """HMAC-SHA256 check over the canonical JSON, as the security module does"""
+    message_str = json.dumps(encrypted_content, sort_keys=True)
+    expected = hmac.new(key, message_str.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+async def measure_loop_lag(clients, messages, payload_size, pool):
+    """Verify signed messages from concurrent clients while probing loop lag"""
+    key = os.urandom(32)
+    content = {"ciphertext": os.urandom(payload_size // 2).hex(), "iv": os.urandom(12).hex()}
+    signature = hmac.new(key, json.dumps(content, sort_keys=True).encode(), hashlib.sha256).hexdigest()
+
+    lags = []
+    done = False
+
+    async def probe(interval=0.001):
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(time.perf_counter() - start - interval)
+
+    async def client():
+        for _ in range(messages):
+            if pool:
+                assert await pool.run(verify_hmac, content, signature, key)
+            else:
+                assert verify_hmac(content, signature, key)
+            await asyncio.sleep(0)  # Next frame from the socket
+
+    probe_task = asyncio.create_task(probe())
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+    done = True
+    await probe_task
+    return elapsed, lags
+
+
+def bench_crypto(args):
+    """Event loop lag while verifying signatures inline vs in the crypto pool"""
+    payload_size = args.payload_kb * 1024
+    total = args.participants * args.messages
+    print(f"{args.participants} clients x {args.messages} signed messages of {args.payload_kb} KB")
+    print(f"{'mode':<10}{'msgs/s':>10}{'lag p50 ms':>12}{'lag p99 ms':>12}{'lag max ms':>12}{'batches':>9}")
+    for mode in ("inline", "pool"):
+        pool = CryptoPool() if mode == "pool" else None
+        elapsed, lags = asyncio.run(measure_loop_lag(args.participants, args.messages, payload_size, pool))
+        lags.sort()
+        p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))]
+        batches = pool.stats["batches"] if pool else "-"
+        print(f"{mode:<10}{total / elapsed:>10.0f}{statistics.median(lags) * 1000:>12.2f}"
+              f"{p99 * 1000:>12.2f}{lags[-1] * 1000:>12.2f}{batches:>9}")
+        if pool:
+            pool.shutdown()
+
+
+def make_signed_traffic(manager, rooms, messages, payload_size):
+    """Rooms with a rotated key each, and messages signed with either version"""
+    now = time.time()
+    for i in range(rooms):
+        manager.ensure(f"match_{i}", os.urandom(32), now - manager.rotation)
+        manager.rotate(f"match_{i}", os.urandom(32), now)
+
+    content = {"ciphertext": os.urandom(payload_size // 2).hex()}
+    message_str = json.dumps(content, sort_keys=True)
+    traffic = []
+    for _ in range(messages):
+        keyring = manager.keyrings[f"match_{random.randrange(rooms)}"]
+        key = random.choice(list(keyring.keys.values()))  # Current or still-valid previous
+        signature = hmac.new(key.derive_signing_key(), message_str.encode(), hashlib.sha256).hexdigest()
+        traffic.append((keyring.room_id, key.key_id, content, signature))
+    return traffic
+
+
+def verify_by_key_id(manager, traffic):
+    for room_id, key_id, content, signature in traffic:
+        assert verify_hmac(content, signature, manager.signing_key(key_id, room_id))
+
+
+def verify_by_trial(manager, traffic):
+    """Baseline without key ids: derive and try each valid version in turn"""
+    for room_id, _, content, signature in traffic:
+        keys = manager.keyrings[room_id].keys.values()
+        assert any(verify_hmac(content, signature, key.derive_signing_key()) for key in keys)
+
+
+def bench_keys(args):
+    """Signature verification throughput as the number of rooms grows"""
+    print(f"{args.messages} signed messages of {args.payload_kb} KB over N rooms, 2 key versions each")
+    print(f"{'rooms':<10}{'key-id msgs/s':>15}{'trial msgs/s':>14}{'cache hit %':>13}")
+    for rooms in (10, 100, 1000, 2000, 10000):
+        manager = RoomKeyManager()
+        traffic = make_signed_traffic(manager, rooms, args.messages, args.payload_kb * 1024)
+        results = []
+        for verify in (verify_by_key_id, verify_by_trial):
+            start = time.perf_counter()
+            verify(manager, traffic)
+            results.append(len(traffic) / (time.perf_counter() - start))
+        lookups = manager.stats["hits"] + manager.stats["misses"]
+        print(f"{rooms:<10}{results[0]:>15.0f}{results[1]:>14.0f}"
+              f"{manager.stats['hits'] / lookups * 100:>13.1f}")
+
+
+SCENARIOS = {
+    "compression": bench_compression,
+    "crypto": bench_crypto,
+    "keys": bench_keys,
+    "ice": bench_ice,
+    "pipeline": bench_pipeline,
+    "startup": bench_startup,
+    "voice": bench_voice,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server benchmarks")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--recipients", type=int, default=50)
+    parser.add_argument("--users", type=int, default=150)
+    parser.add_argument("--threshold", type=int, default=512)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--participants", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--window", type=float, default=0.005, help="ICE batch window (seconds)")
+    parser.add_argument("--payload-kb", type=int, default=256, help="Signed payload size (crypto, keys)")
+    args = parser.parse_args()
+    SCENARIOS[args.scenario](args)
+
+
+if __name__ == "__main__":
+    main()
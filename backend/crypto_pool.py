@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Crypto Pool
+Runs CPU-bound security work (signature checks, key generation) on a
+bounded thread pool instead of the event loop.
+
+hashlib and hmac release the GIL while they hash large buffers, so a
+thread pool keeps the loop responsive without having to pickle keys over
+to another process. Jobs submitted in the same loop iteration are handed
+to the pool together, split into at most one chunk per worker. The chunks
+run in parallel, and each caller waits only for its own chunk. When
+max_pending jobs are already in flight, callers wait for a slot. That
+pauses the sending connection's read loop, so the backpressure reaches
+the client over TCP.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+CRYPTO_WORKERS = int(os.environ.get("CRYPTO_WORKERS", min(4, os.cpu_count() or 1)))
+CRYPTO_MAX_PENDING = int(os.environ.get("CRYPTO_MAX_PENDING", 256))
+CRYPTO_BATCH_SIZE = int(os.environ.get("CRYPTO_BATCH_SIZE", 32))
+
+
+def run_batch(jobs):
+    """Run [(fn, args), ...] in a worker; returns [(ok, result or exception), ...]"""
+    results = []
+    for fn, args in jobs:
+        try:
+            results.append((True, fn(*args)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+class CryptoPool:
+    def __init__(self, workers=CRYPTO_WORKERS, max_pending=CRYPTO_MAX_PENDING,
+                 batch_size=CRYPTO_BATCH_SIZE):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+
+        self._executor = None  # Threads start on first use
+        self._slots = None  # Semaphore, created on the running loop
+        self.batch = []  # (fn, args, future) waiting to be handed to the pool
+        self.flush_scheduled = False
+        self.stats = {"jobs": 0, "batches": 0, "waited": 0}
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="crypto")
+        return self._executor
+
+    async def run(self, fn, *args):
+        """Run fn(*args) in the pool and return its result"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        if self._slots.locked():
+            self.stats["waited"] += 1
+
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.batch.append((fn, args, future))
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+            elif not self.flush_scheduled:
+                # Whatever else is submitted this iteration joins the batch
+                self.flush_scheduled = True
+                loop.call_soon(self.flush)
+            return await future
+
+    def flush(self):
+        """Hand the pending batch to the pool"""
+        self.flush_scheduled = False
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+
+        self.stats["jobs"] += len(batch)
+        self.stats["batches"] += 1
+        loop = asyncio.get_running_loop()
+        chunk_size = -(-len(batch) // self.workers)  # Ceiling division
+        for start in range(0, len(batch), chunk_size):
+            chunk = batch[start:start + chunk_size]
+            done = loop.run_in_executor(self.executor, run_batch, [(fn, args) for fn, args, _ in chunk])
+            done.add_done_callback(lambda done, chunk=chunk: self._resolve(chunk, done))
+
+    def _resolve(self, chunk, done):
+        if done.exception() is not None:
+            results = [(False, done.exception())] * len(chunk)
+        else:
+            results = done.result()
+
+        for (_, _, future), (ok, result) in zip(chunk, results):
+            if future.done():
+                continue  # Caller gave up (e.g. its connection closed)
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Presence
+Ephemeral per-room state for typing indicators and read receipts.
+
+Clients report typing and read positions as often as they like; the server
+only records them. Aggregated snapshots are pushed at a fixed rate, and only
+for rooms whose state changed since the last push, so broadcast traffic stays
+bounded however fast clients send updates.
+"""
+
+import os
+import time
+
+PRESENCE_INTERVAL = float(os.environ.get("PRESENCE_INTERVAL", 0.5))  # seconds
+TYPING_TIMEOUT = 5.0  # seconds a typing flag lasts without a refresh
+
+
+class RoomPresence:
+    def __init__(self):
+        self.typing = {}  # nickname -> expires at (monotonic)
+        self.last_read = {}  # nickname -> highest seq read
+        self.last_pushed = None
+
+    def state(self):
+        return (tuple(sorted(self.typing)), tuple(sorted(self.last_read.items())))
+
+
+class PresenceTracker:
+    def __init__(self, typing_timeout=TYPING_TIMEOUT):
+        self.typing_timeout = typing_timeout
+        self.rooms = {}  # room key -> RoomPresence
+
+    def set_typing(self, room, nickname, is_typing, now=None):
+        now = time.monotonic() if now is None else now
+        presence = self.rooms.setdefault(room, RoomPresence())
+        if is_typing:
+            presence.typing[nickname] = now + self.typing_timeout
+        else:
+            presence.typing.pop(nickname, None)
+
+    def mark_read(self, room, nickname, seq):
+        presence = self.rooms.setdefault(room, RoomPresence())
+        # Read positions only move forward
+        if seq > presence.last_read.get(nickname, -1):
+            presence.last_read[nickname] = seq
+
+    def remove_user(self, room, nickname):
+        presence = self.rooms.get(room)
+        if presence:
+            presence.typing.pop(nickname, None)
+            presence.last_read.pop(nickname, None)
+
+    def drop_room(self, room):
+        self.rooms.pop(room, None)
+
+    def collect_changes(self, now=None):
+        """Expire stale typing flags; return (room, snapshot) for changed rooms"""
+        now = time.monotonic() if now is None else now
+        changes = []
+        for room, presence in list(self.rooms.items()):
+            for nickname, expires_at in list(presence.typing.items()):
+                if expires_at <= now:
+                    del presence.typing[nickname]
+
+            state = presence.state()
+            if state == presence.last_pushed:
+                continue
+            presence.last_pushed = state
+            typing, read = state
+            changes.append((room, {"typing": list(typing), "read": dict(read)}))
+
+            if not typing and not read:
+                # Nothing left to report; forget the room after this push
+                del self.rooms[room]
+        return changes
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Room Keys
+Per-room key management. Each room (the lobby and every match room) has
+its own keyring of versioned secrets. The secrets never leave the server.
+Clients receive a signing key derived from one version, tagged with a
+key id.
+
+Rotation adds a new version and keeps the previous one valid for an
+overlap window, so messages signed just before a rotation still verify.
+Verification looks up the key by the message's key id. Derived keys sit
+in a bounded LRU, so a lookup is a dict hit however many rooms exist.
+
+Key ids carry a random per-process epoch. Versions restart at 1 after a
+restart, so without the epoch a key id from before a restart would name
+a different secret afterwards.
+"""
+
+import hashlib
+import hmac
+import os
+import time
+from collections import OrderedDict
+
+ROOM_KEY_ROTATION = int(os.environ.get("ROOM_KEY_ROTATION", 3600))  # seconds
+ROOM_KEY_OVERLAP = int(os.environ.get("ROOM_KEY_OVERLAP", 300))  # seconds
+DERIVED_KEY_CACHE_SIZE = int(os.environ.get("DERIVED_KEY_CACHE_SIZE", 4096))
+
+LOBBY_ROOM = "lobby"  # Keyring for the main chat
+KEY_EPOCH = os.urandom(4).hex()  # Distinguishes this process's key ids
+
+
+def make_key_id(room_id, version):
+    return f"{room_id}/{KEY_EPOCH}/{version}"
+
+
+def parse_key_id(key_id):
+    """Split a key id into (room_id, epoch, version); raises ValueError if malformed"""
+    room_id, epoch, version = key_id.rsplit("/", 2)
+    return room_id, epoch, int(version)
+
+
+class RoomKey:
+    def __init__(self, room_id, version, secret, created_at):
+        self.room_id = room_id
+        self.version = version
+        self.key_id = make_key_id(room_id, version)
+        self.secret = secret
+        self.created_at = created_at
+        self.expires_at = None  # Set once a newer version replaces it
+
+    def is_valid(self, now):
+        return self.expires_at is None or now < self.expires_at
+
+    def derive_signing_key(self):
+        # Bound to the key id, so a signing key is useless for any other
+        # room or version
+        return hmac.new(self.secret, f"signing:{self.key_id}".encode(), hashlib.sha256).digest()
+
+
+class RoomKeyring:
+    """Versions of one room's key; the newest is current"""
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.keys = {}  # version -> RoomKey
+        self.current = None
+
+    def add(self, secret, now, overlap):
+        version = self.current.version + 1 if self.current else 1
+        if self.current:
+            self.current.expires_at = now + overlap
+        self.current = self.keys[version] = RoomKey(self.room_id, version, secret, now)
+        return self.current
+
+    def prune(self, now):
+        """Drop expired versions; returns their key ids"""
+        expired = [key for key in self.keys.values() if not key.is_valid(now)]
+        for key in expired:
+            del self.keys[key.version]
+        return [key.key_id for key in expired]
+
+
+class RoomKeyManager:
+    def __init__(self, rotation=ROOM_KEY_ROTATION, overlap=ROOM_KEY_OVERLAP,
+                 cache_size=DERIVED_KEY_CACHE_SIZE):
+        self.rotation = rotation
+        self.overlap = overlap
+        self.cache_size = cache_size
+        self.keyrings = {}  # room_id -> RoomKeyring
+        self.derived = OrderedDict()  # key_id -> (RoomKey, signing key), LRU order
+        self.stats = {"hits": 0, "misses": 0}
+
+    def current_key(self, room_id):
+        keyring = self.keyrings.get(room_id)
+        return keyring.current if keyring else None
+
+    def ensure(self, room_id, secret, now=None):
+        """Current key for a room, creating the keyring with secret if needed"""
+        keyring = self.keyrings.get(room_id)
+        if keyring is None:
+            keyring = self.keyrings[room_id] = RoomKeyring(room_id)
+            keyring.add(secret, time.time() if now is None else now, self.overlap)
+        return keyring.current
+
+    def rotate(self, room_id, secret, now=None):
+        """Make secret the room's current key; the old one lasts the overlap window"""
+        keyring = self.keyrings.setdefault(room_id, RoomKeyring(room_id))
+        return keyring.add(secret, time.time() if now is None else now, self.overlap)
+
+    def due_for_rotation(self, now=None):
+        now = time.time() if now is None else now
+        return [room_id for room_id, keyring in self.keyrings.items()
+                if now - keyring.current.created_at >= self.rotation]
+
+    def prune(self, now=None):
+        """Forget expired key versions"""
+        now = time.time() if now is None else now
+        for keyring in self.keyrings.values():
+            for key_id in keyring.prune(now):
+                self.derived.pop(key_id, None)
+
+    def drop(self, room_id):
+        """Forget a room's keys, e.g. once its match room is gone"""
+        keyring = self.keyrings.pop(room_id, None)
+        if keyring:
+            for key in keyring.keys.values():
+                self.derived.pop(key.key_id, None)
+
+    def signing_key(self, key_id, room_id, now=None):
+        """Derived signing key for a key id of room_id, or None if unknown or expired"""
+        if not isinstance(key_id, str):
+            return None
+        now = time.time() if now is None else now
+        entry = self.derived.get(key_id)
+        if entry is not None:
+            self.stats["hits"] += 1
+            self.derived.move_to_end(key_id)
+        else:
+            self.stats["misses"] += 1
+            try:
+                key_room, epoch, version = parse_key_id(key_id)
+            except (AttributeError, ValueError):
+                return None
+            if epoch != KEY_EPOCH:
+                return None  # Issued before a restart
+            keyring = self.keyrings.get(key_room)
+            key = keyring.keys.get(version) if keyring else None
+            if key is None:
+                return None
+            entry = self.derived[key_id] = (key, key.derive_signing_key())
+            if len(self.derived) > self.cache_size:
+                self.derived.popitem(last=False)
+
+        key, signing_key = entry
+        if key.room_id != room_id or not key.is_valid(now):
+            return None
+        return signing_key
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Room Shards
+Partitions match rooms across worker event loops, each running in its own
+thread.
+
+A room belongs to exactly one shard, picked by hashing its id. Everything
+about the room runs on that shard's loop: membership, sequence numbers,
+typing/read state, and serialising and compressing its broadcasts.
+Connections stay on the main loop. The main loop is also the hub for the
+global chat, the user list and matchmaking.
+
+The hub and the shards share no state. They talk only through thread-safe
+queues:
+- the hub hands room operations to a shard with submit(). It awaits the
+  ones that produce output and gets their frames back with the result
+  (see collect()). It then sends them like its own replies, so each
+  connection sees its replies in request order.
+- frames a shard produces on its own, such as presence, go back through
+  deliver(). Each connection has its own writer, so a slow socket only
+  holds up itself.
+
+Shards only help when room work can run in parallel with the hub, for
+example on a free-threaded build or when broadcasts are I/O heavy. With
+ROOM_SHARDS=0 (the default) the single shard runs on the main loop.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import zlib
+from datetime import datetime
+
+import websockets
+
+from frame_codec import FrameEncoder
+from presence import PresenceTracker, PRESENCE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+ROOM_SHARDS = int(os.environ.get("ROOM_SHARDS", 0))
+
+
+class RoomShard:
+    """Owns a subset of the match rooms; only touched from its own loop"""
+
+    def __init__(self, index, hub):
+        self.index = index
+        self.hub = hub
+        self.loop = None
+        self.thread = None
+        self.output = None  # Frames of the operation being collected
+
+        self.rooms = {}  # room_id -> {"users": {ws: nickname}, "room_name", "created_at"}
+        self.client_encodings = {}  # websocket -> negotiated frame encoding
+        self.room_seq = {}  # room_id -> last message sequence number
+        self.presence = PresenceTracker()
+        self.frame_encoder = FrameEncoder()
+
+    def start(self, loop=None):
+        """Run on the given loop, or on a new loop in a dedicated thread"""
+        if loop is not None:
+            self.loop = loop
+            self.loop.create_task(self.run_presence_loop())
+            return
+
+        ready = threading.Event()
+
+        def run_loop():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.create_task(self.run_presence_loop())
+            self.loop.call_soon(ready.set)
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run_loop, name=f"room-shard-{self.index}", daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) to run on this shard's loop; safe from any thread
+
+        Operations run one at a time, in the order they were submitted.
+        Returns a concurrent Future holding fn's result.
+        """
+        future = concurrent.futures.Future()
+        self.loop.call_soon_threadsafe(self._run, fn, args, future)
+        return future
+
+    async def call(self, fn, *args):
+        """Submit from a coroutine on another loop and wait for the result"""
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def collect(self, fn, *args):
+        """Run fn(*args) and return (result, frames) instead of delivering them
+
+        frames is [(websocket, message_str, frames cache), ...]. The cache
+        already holds the compressed frame for each recipient's encoding.
+        """
+        self.output = []
+        try:
+            return fn(*args), self.output
+        finally:
+            self.output = None
+
+    def _run(self, fn, args, future):
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            logger.error(f"Room shard {self.index}: error in {fn.__name__}: {e}")
+            future.set_exception(e)
+
+    # Output - frames are encoded here and written by the hub
+    def emit(self, websocket, message_str, frames):
+        frame = self.frame_encoder.encode(message_str, self.client_encodings.get(websocket), frames)
+        if self.output is not None:
+            self.output.append((websocket, message_str, frames))
+        else:
+            self.hub.deliver([(websocket, frame)])
+
+    def send_json(self, websocket, message):
+        self.emit(websocket, json.dumps(message), {})
+
+    def broadcast_to_room(self, room_id, message, exclude=None):
+        """Broadcast message to all users in a specific room"""
+        room = self.rooms.get(room_id)
+        if not room:
+            return
+
+        message_str = json.dumps(message)
+        frames = {}  # Compressed once per encoding
+        for websocket in room["users"]:
+            if websocket != exclude:
+                self.emit(websocket, message_str, frames)
+
+    def next_seq(self, room_id):
+        """Next message sequence number in a room, for read receipts"""
+        self.room_seq[room_id] = self.room_seq.get(room_id, 0) + 1
+        return self.room_seq[room_id]
+
+    # Room operations, submitted by the hub
+    def create_room(self, room_id, room_name, players):
+        """Set up a match room for [(websocket, nickname, encoding), ...]"""
+        self.rooms[room_id] = {
+            "users": {},
+            "room_name": room_name,
+            "created_at": datetime.now().isoformat()
+        }
+        for websocket, nickname, encoding in players:
+            self.add_member(room_id, websocket, nickname, encoding)
+
+        # Notify each player, naming the other as their opponent
+        (user1, nickname1, _), (user2, nickname2, _) = players
+        for websocket, opponent in ((user1, nickname2), (user2, nickname1)):
+            self.send_json(websocket, {
+                "type": "match_found",
+                "room_id": room_id,
+                "room_name": room_name,
+                "opponent": opponent,
+                "message": "Match found! You've been placed in a private room."
+            })
+
+        # Send welcome message to the room
+        self.broadcast_to_room(room_id, {
+            "type": "system_message",
+            "message": f"Welcome to {room_name}! {nickname1} and {nickname2} have been matched.",
+            "timestamp": datetime.now().isoformat()
+        })
+
+    def add_member(self, room_id, websocket, nickname, encoding):
+        self.rooms[room_id]["users"][websocket] = nickname
+        if encoding:
+            self.client_encodings[websocket] = encoding
+
+    def rejoin_room(self, room_id, websocket, nickname, encoding, metadata=None):
+        """Put a resumed client back in its room; returns the room name or None"""
+        room = self.rooms.get(room_id)
+        if room is None:
+            if metadata is None:
+                return None
+            # Recreate a room that existed before a restart
+            room = self.rooms[room_id] = {
+                "users": {},
+                "room_name": metadata["room_name"],
+                "created_at": metadata["created_at"]
+            }
+        self.add_member(room_id, websocket, nickname, encoding)
+        return room["room_name"]
+
+    def leave_room(self, room_id, websocket):
+        """Remove a user, tell whoever is left, and delete the room once empty"""
+        self.client_encodings.pop(websocket, None)
+        room = self.rooms.get(room_id)
+        if not room:
+            return
+
+        nickname = room["users"].pop(websocket, "Unknown")
+        self.presence.remove_user(room_id, nickname)
+        self.broadcast_to_room(room_id, {
+            "type": "opponent_left",
+            "message": f"{nickname} has left the room",
+            "timestamp": datetime.now().isoformat()
+        })
+
+        if not room["users"]:
+            del self.rooms[room_id]
+            self.presence.drop_room(room_id)
+            self.room_seq.pop(room_id, None)
+            logger.info(f"Room {room_id} deleted (empty)")
+
+    def rename_member(self, room_id, websocket, old_nickname, nickname):
+        room = self.rooms.get(room_id)
+        if room and websocket in room["users"]:
+            room["users"][websocket] = nickname
+            self.presence.remove_user(room_id, old_nickname)
+
+    def room_message(self, room_id, websocket, content, encrypted=None):
+        """Send message to room (only room members can see it)
+
+        encrypted carries encrypted_content, signature and key_id of a
+        message the hub has already verified; content is then None.
+        """
+        room = self.rooms.get(room_id)
+        if not room or websocket not in room["users"]:
+            return
+
+        nickname = room["users"][websocket]
+        self.presence.set_typing(room_id, nickname, False)
+        message = {
+            "type": "encrypted_room_message" if encrypted else "room_message",
+            "room_id": room_id,
+            "nickname": nickname,
+            "timestamp": datetime.now().isoformat(),
+            "seq": self.next_seq(room_id)
+        }
+        message.update(encrypted or {"content": content})
+        self.broadcast_to_room(room_id, message)
+
+    def set_typing(self, room_id, websocket, is_typing):
+        room = self.rooms.get(room_id)
+        if room and websocket in room["users"]:
+            self.presence.set_typing(room_id, room["users"][websocket], is_typing)
+
+    def mark_read(self, room_id, websocket, seq):
+        room = self.rooms.get(room_id)
+        if room and websocket in room["users"] and 0 < seq <= self.room_seq.get(room_id, 0):
+            self.presence.mark_read(room_id, room["users"][websocket], seq)
+
+    def room_info(self, room_id, websocket):
+        """Send room details to a member; returns False if the room is gone"""
+        room = self.rooms.get(room_id)
+        if not room:
+            return False
+
+        self.send_json(websocket, {
+            "type": "room_info",
+            "in_room": True,
+            "room_id": room_id,
+            "room_name": room["room_name"],
+            "members": list(room["users"].values()),
+            "created_at": room["created_at"]
+        })
+        return True
+
+    def room_metadata(self):
+        """Room names and creation times, for the drain snapshot"""
+        return {
+            room_id: {"room_name": room["room_name"], "created_at": room["created_at"]}
+            for room_id, room in self.rooms.items()
+        }
+
+    async def run_presence_loop(self, interval=PRESENCE_INTERVAL):
+        """Push typing/read snapshots at a fixed rate, only for rooms that changed"""
+        while True:
+            await asyncio.sleep(interval)
+            for room_id, snapshot in self.presence.collect_changes():
+                self.broadcast_to_room(room_id, {"type": "presence", "room_id": room_id, **snapshot})
+
+
+class RoomShards:
+    """Routes rooms to shards and writes the frames shards produce"""
+
+    def __init__(self, count=ROOM_SHARDS):
+        self.count = count
+        self.shards = [RoomShard(index, self) for index in range(max(1, count))]
+        self.loop = None
+        self.writers = {}  # websocket -> queue of frames its writer task sends
+        self.writer_tasks = set()
+
+    def start(self):
+        """Start the shards; call from the hub (main) loop"""
+        self.loop = asyncio.get_running_loop()
+        for shard in self.shards:
+            shard.start(self.loop if self.count < 1 else None)
+        logger.info(f"Match rooms spread over {len(self.shards)} shard(s)")
+
+    def shard_for(self, room_id):
+        # crc32 rather than hash(): stable across restarts, so a resumed
+        # room lands on the same shard index
+        return self.shards[zlib.crc32(room_id.encode()) % len(self.shards)]
+
+    def deliver(self, deliveries):
+        """Queue [(websocket, frame), ...] for the hub to send; safe from any thread"""
+        if deliveries:
+            self.loop.call_soon_threadsafe(self._enqueue, deliveries)
+
+    def _enqueue(self, deliveries):
+        for websocket, frame in deliveries:
+            queue = self.writers.get(websocket)
+            if queue is None:
+                queue = self.writers[websocket] = asyncio.Queue()
+                task = self.loop.create_task(self.run_writer(websocket, queue))
+                self.writer_tasks.add(task)
+                task.add_done_callback(self.writer_tasks.discard)
+            queue.put_nowait(frame)
+
+    async def run_writer(self, websocket, queue):
+        """Send one connection's frames in order; exits once it has caught up"""
+        try:
+            while not queue.empty():
+                await websocket.send(queue.get_nowait())
+        except websockets.exceptions.ConnectionClosed:
+            pass  # Its own handler unregisters it
+        finally:
+            self.writers.pop(websocket, None)
+
+    async def room_metadata(self):
+        rooms = {}
+        for shard in self.shards:
+            rooms.update(await shard.call(shard.room_metadata))
+        return rooms
@@ -2,27 +2,58 @@
 """
 LAN Chat Server - Secure Edition
 A WebSocket-based chat server with end-to-end encryption and security features.
+
+Startup is kept short for cold starts (e.g. a sleeping free-tier instance
+being woken by its first connection): the HTTP discovery service is
+imported only when first used, and the listening socket is opened before
+any non-critical initialisation runs. The security module is loaded right
+after the socket opens; every message needs it, so the server stops if it
+cannot be loaded.
 """
 
+import time
+
+PROCESS_START = time.perf_counter()
+
 import asyncio
 import websockets
+import contextvars
+import importlib
 import json
 import logging
 from datetime import datetime
 import socket
-import threading
-import time
 import platform
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import signal
 from urllib.parse import parse_qs, urlparse
-import ssl
 import os
-from secure_server import SecureServerManager
+from frame_codec import FrameEncoder, negotiate_encoding
+from session_snapshot import new_resume_token, write_snapshot, load_snapshot
+from admission import AdmissionController, CLOSE_TRY_AGAIN_LATER
+from presence import PresenceTracker, PRESENCE_INTERVAL
+from room_shards import RoomShards
+from crypto_pool import CryptoPool
+from room_keys import RoomKeyManager, LOBBY_ROOM
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Inbound frames already buffered on a connection are handled as one batch
+MAX_INBOUND_BATCH = int(os.environ.get("MAX_INBOUND_BATCH", 32))
+
+# Outbound frames produced while a batch is being handled (recipient -> frames)
+current_outbox = contextvars.ContextVar("current_outbox", default=None)
+
+RATE_LIMIT_ERROR = "Too many requests. Please slow down."
+
+# Proxies in front of the server in the cloud (the platform's load balancer);
+# 0 ignores X-Forwarded-For entirely
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", 1))
+
+# Resumes within this window share one user_list broadcast
+RESUME_USER_LIST_DELAY = float(os.environ.get("RESUME_USER_LIST_DELAY", 0.25))  # seconds
+
 class ServerDiscovery:
     """Handle server discovery and announcement"""
     
@@ -44,6 +75,9 @@ class ServerDiscovery:
     
     def start_discovery_server(self):
         """Start HTTP server for server discovery"""
+        import threading
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        
         class DiscoveryHandler(BaseHTTPRequestHandler):
             def do_GET(self):
                 if self.path == '/discover':
@@ -90,27 +124,73 @@ class ChatServer:
         self.clients = set()
         self.nicknames = {}  # websocket -> nickname mapping
         self.client_sessions = {}  # websocket -> session_id mapping
-        self.security_manager = SecureServerManager()
-        self.room_key = None  # Shared encryption key for the room
+        self._security_manager = None  # Created on first use, see security_manager
+        self.room_keys = RoomKeyManager()  # Per-room keyrings (lobby and match rooms)
         self.failed_attempts = {}  # Track failed authentication attempts
+        self.frame_encoder = FrameEncoder()
+        self.client_encodings = {}  # websocket -> negotiated frame encoding
+        self.batch_clients = set()  # Clients that accept combined "batch" frames
+        self.admission = AdmissionController()
+        self.crypto_pool = CryptoPool()  # Signature checks and key generation
         
-        # Matchmaking system
+        # Matchmaking system; the rooms themselves live on room shards
         self.matchmaking_queue = []  # List of users waiting for match
-        self.active_rooms = {}  # room_id -> {"users": [ws1, ws2], "room_name": str}
+        self.shards = RoomShards()
         self.user_rooms = {}  # websocket -> room_id mapping
         self.room_counter = 0
         
-    async def register_client(self, websocket):
+        # Typing indicators and read receipts for the main chat
+        self.presence = PresenceTracker()
+        self.room_seq = {}  # LOBBY_ROOM -> last message sequence number
+        
+        # Graceful drain and session resumption
+        self.draining = False
+        self.resumable_sessions = {}  # resume token -> session from snapshot
+        self.restored_rooms = {}  # room_id -> room metadata from snapshot
+        self.resume_expires_at = 0
+        self.resumed_positions = {}  # websocket -> queue position before restart
+        self.user_list_scheduled = False
+        
+    @property
+    def security_manager(self):
+        """Security manager, imported and constructed lazily"""
+        if self._security_manager is None:
+            from secure_server import SecureServerManager
+            self._security_manager = SecureServerManager()
+        return self._security_manager
+        
+    async def register_client(self, websocket, path="/"):
         """Register a new client"""
         self.clients.add(websocket)
+        
+        # Clients opt into compressed frames with ?encoding=... on the URL
+        query = parse_qs(urlparse(path).query)
+        encoding = negotiate_encoding(query.get("encoding"))
+        if encoding:
+            self.client_encodings[websocket] = encoding
+        if query.get("batch") == ["1"]:
+            self.batch_clients.add(websocket)
+            
         logger.info(f"Client connected. Total clients: {len(self.clients)}")
         
     async def unregister_client(self, websocket):
         """Unregister a client"""
         self.clients.discard(websocket)
+        self.client_encodings.pop(websocket, None)
+        self.batch_clients.discard(websocket)
+        self.resumed_positions.pop(websocket, None)
         nickname = self.nicknames.pop(websocket, "Unknown")
         logger.info(f"Client {nickname} disconnected. Total clients: {len(self.clients)}")
         
+        self.presence.remove_user(LOBBY_ROOM, nickname)
+        
+        if self.draining:
+            # Everyone is leaving and will resume elsewhere - no notifications
+            if websocket in self.matchmaking_queue:
+                self.matchmaking_queue.remove(websocket)
+            self.user_rooms.pop(websocket, None)
+            return
+        
         # Clean up matchmaking and room data
         await self.cleanup_user_matchmaking_data(websocket)
         
@@ -124,6 +204,10 @@ class ChatServer:
             
     async def set_nickname(self, websocket, nickname):
         """Set nickname for a client"""
+        # Re-sending the current nickname (e.g. after a resume) is a no-op
+        if self.nicknames.get(websocket) == nickname:
+            return True
+            
         # Check if nickname is already taken
         if nickname in self.nicknames.values():
             return False
@@ -133,6 +217,11 @@ class ChatServer:
         
         if old_nickname:
             # Nickname changed
+            self.presence.remove_user(LOBBY_ROOM, old_nickname)
+            room_id = self.user_rooms.get(websocket)
+            if room_id:
+                shard = self.shards.shard_for(room_id)
+                shard.submit(shard.rename_member, room_id, websocket, old_nickname, nickname)
             await self.broadcast_message({
                 "type": "nickname_changed",
                 "old_nickname": old_nickname,
@@ -149,12 +238,110 @@ class ChatServer:
             
         return True
         
+    async def send_frame(self, websocket, message_str, frames=None):
+        """Send a serialized frame, compressing it if large enough"""
+        outbox = current_outbox.get()
+        if outbox is not None:
+            # Inside an inbound batch: hold it so the batch's output to each
+            # recipient goes out together, in order
+            outbox.setdefault(websocket, []).append((message_str, frames))
+            return
+        encoding = self.client_encodings.get(websocket)
+        await websocket.send(self.frame_encoder.encode(message_str, encoding, frames))
+        
+    async def flush_outbox(self, outbox, websocket=None):
+        """Send held frames, combining them per recipient where supported"""
+        recipients = [websocket] if websocket is not None else list(outbox)
+        combined_frames = {}  # messages -> (batch frame, its per-encoding cache)
+        for recipient in recipients:
+            pending = outbox.pop(recipient, None)
+            if not pending:
+                continue
+            encoding = self.client_encodings.get(recipient)
+            try:
+                if len(pending) > 1 and recipient in self.batch_clients:
+                    # Recipients of the same broadcasts share one batch frame,
+                    # compressed once per encoding like a single broadcast
+                    messages = tuple(message_str for message_str, _ in pending)
+                    if messages not in combined_frames:
+                        frame = f'{{"type": "batch", "messages": [{", ".join(messages)}]}}'
+                        combined_frames[messages] = (frame, {})
+                    frame, frames = combined_frames[messages]
+                    await recipient.send(self.frame_encoder.encode(frame, encoding, frames))
+                else:
+                    for message_str, frames in pending:
+                        await recipient.send(self.frame_encoder.encode(message_str, encoding, frames))
+            except websockets.exceptions.ConnectionClosed:
+                pass  # Its own handler unregisters it
+                
+    async def flush_current_outbox(self):
+        """Send what the current batch holds so far; call before an await that can block"""
+        outbox = current_outbox.get()
+        if outbox is not None:
+            await self.flush_outbox(outbox)
+            
+    async def handle_batch(self, websocket, batch):
+        """Handle buffered frames in order, coalescing the frames they produce"""
+        # Validate the whole batch up front; nothing past a rate-limited
+        # frame is handled
+        client_ip = get_client_ip(websocket)
+        checked = []
+        for message_data in batch:
+            data, error = self.check_message(client_ip, message_data)
+            checked.append((data, error))
+            if error == RATE_LIMIT_ERROR:
+                break
+                
+        outbox = {}
+        token = current_outbox.set(outbox)
+        try:
+            for data, error in checked:
+                if error == RATE_LIMIT_ERROR:
+                    await self.send_json(websocket, {
+                        "type": "error",
+                        "message": error
+                    })
+                    await self.close_client(websocket, 1008, "Rate limit exceeded")
+                    break
+                elif error:
+                    await self.send_json(websocket, {
+                        "type": "error",
+                        "message": error
+                    })
+                else:
+                    await self.handle_message(websocket, data)
+                if websocket.closed:
+                    break
+        finally:
+            current_outbox.reset(token)
+            await self.flush_outbox(outbox)
+        
+    async def room_call(self, room_id, operation, *args):
+        """Run a room operation on its shard and send the frames it produced
+
+        They go out through send_frame, so they keep their place among the
+        requester's other replies.
+        """
+        shard = self.shards.shard_for(room_id)
+        result, output = await shard.call(shard.collect, getattr(shard, operation), *args)
+        for websocket, message_str, frames in output:
+            try:
+                await self.send_frame(websocket, message_str, frames)
+            except websockets.exceptions.ConnectionClosed:
+                pass  # Its own handler unregisters it
+        return result
+        
+    async def send_json(self, websocket, message):
+        """Send a message to a single client"""
+        await self.send_frame(websocket, json.dumps(message))
+        
     async def broadcast_message(self, message, exclude=None):
         """Broadcast message to all connected clients except excluded one"""
         if not self.clients:
             return
             
         message_str = json.dumps(message)
+        frames = {}  # Compressed once per encoding, shared by all recipients
         disconnected = set()
         
         for client in self.clients.copy():
@@ -162,7 +349,7 @@ class ChatServer:
                 continue
                 
             try:
-                await client.send(message_str)
+                await self.send_frame(client, message_str, frames)
             except websockets.exceptions.ConnectionClosed:
                 disconnected.add(client)
                 
@@ -170,24 +357,18 @@ class ChatServer:
         for client in disconnected:
             await self.unregister_client(client)
             
-    async def handle_message(self, websocket, message_data):
-        """Handle incoming message from client"""
+    async def handle_message(self, websocket, data):
+        """Handle a parsed and validated message from a client"""
         try:
-            # Secure JSON parsing with size limits
-            data = self.security_manager.secure_json_loads(message_data)
             message_type = data.get("type")
             
-            # Validate all input data
-            if not await self.validate_client_input(websocket, data):
-                return
-            
             if message_type == "set_nickname":
                 nickname = data.get("nickname", "").strip()
                 if not nickname:
-                    await websocket.send(json.dumps({
+                    await self.send_json(websocket, {
                         "type": "error",
                         "message": "Nickname cannot be empty"
-                    }))
+                    })
                     return
                 
                 # Security validation and sanitization
@@ -196,38 +377,55 @@ class ChatServer:
                     if not nickname:
                         raise ValueError("Invalid nickname")
                 except ValueError as e:
-                    await websocket.send(json.dumps({
+                    await self.send_json(websocket, {
                         "type": "error",
                         "message": "Invalid nickname format"
-                    }))
+                    })
                     return
                     
-                success = await self.set_nickname(websocket, nickname)
-                if success:
-                    await websocket.send(json.dumps({
-                        "type": "nickname_set",
-                        "nickname": nickname
-                    }))
+                # A first join broadcasts to everyone; cap how many run at once
+                first_join = websocket not in self.nicknames
+                if first_join:
+                    await self.flush_current_outbox()  # Waiting for a slot can take seconds
+                    rejection = await self.admission.begin_handshake()
+                    if rejection:
+                        await self.close_client(websocket, CLOSE_TRY_AGAIN_LATER, rejection)
+                        return
+                        
+                try:
+                    success = await self.set_nickname(websocket, nickname)
+                    if success:
+                        await self.send_json(websocket, {
+                            "type": "nickname_set",
+                            "nickname": nickname
+                        })
                     
-                    # Send current user list
-                    user_list = list(self.nicknames.values())
-                    await websocket.send(json.dumps({
-                        "type": "user_list",
-                        "users": user_list
-                    }))
-                else:
-                    await websocket.send(json.dumps({
-                        "type": "error",
-                        "message": "Nickname already taken"
-                    }))
+                        # Send current user list
+                        user_list = list(self.nicknames.values())
+                        await self.send_json(websocket, {
+                            "type": "user_list",
+                            "users": user_list
+                        })
+                    else:
+                        await self.send_json(websocket, {
+                            "type": "error",
+                            "message": "Nickname already taken"
+                        })
+                finally:
+                    if first_join:
+                        # Hold the slot until the join broadcast has gone out
+                        try:
+                            await self.flush_current_outbox()
+                        finally:
+                            self.admission.end_handshake()
                     
             elif message_type == "chat_message":
                 nickname = self.nicknames.get(websocket)
                 if not nickname:
-                    await websocket.send(json.dumps({
+                    await self.send_json(websocket, {
                         "type": "error",
                         "message": "Please set a nickname first"
-                    }))
+                    })
                     return
                 
                 # Handle encrypted message
@@ -240,19 +438,21 @@ class ChatServer:
                     return
                     
                 # Broadcast chat message
+                self.presence.set_typing(LOBBY_ROOM, nickname, False)
                 await self.broadcast_message({
                     "type": "chat_message",
                     "nickname": nickname,
                     "content": content,
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": datetime.now().isoformat(),
+                    "seq": self.next_seq(LOBBY_ROOM)
                 })
                 
             elif message_type == "get_users":
                 user_list = list(self.nicknames.values())
-                await websocket.send(json.dumps({
+                await self.send_json(websocket, {
                     "type": "user_list",
                     "users": user_list
-                }))
+                })
                 
             # Matchmaking message handlers
             elif message_type == "join_matchmaking":
@@ -265,6 +465,13 @@ class ChatServer:
                 await self.leave_room(websocket)
                 
             elif message_type == "room_message":
+                if "encrypted_content" in data and websocket in self.user_rooms:
+                    await self.handle_encrypted_message(
+                        websocket, data, self.nicknames.get(websocket, "Unknown"),
+                        self.user_rooms[websocket]
+                    )
+                    return
+                    
                 content = data.get("content", "").strip()
                 if content:
                     await self.send_room_message(websocket, content)
@@ -272,104 +479,179 @@ class ChatServer:
             elif message_type == "get_room_info":
                 await self.get_room_info(websocket)
                 
-        except json.JSONDecodeError:
-            await websocket.send(json.dumps({
-                "type": "error",
-                "message": "Invalid message format"
-            }))
+            elif message_type == "get_room_key":
+                if self.nicknames.get(websocket):
+                    await self.initialize_room_encryption(
+                        websocket, self.user_rooms.get(websocket, LOBBY_ROOM)
+                    )
+                
+            # Ephemeral state: recorded here, pushed by run_presence_loop
+            elif message_type == "typing":
+                nickname = self.nicknames.get(websocket)
+                room_id = self.user_rooms.get(websocket)
+                if room_id:
+                    shard = self.shards.shard_for(room_id)
+                    shard.submit(shard.set_typing, room_id, websocket, bool(data.get("typing")))
+                elif nickname:
+                    self.presence.set_typing(LOBBY_ROOM, nickname, bool(data.get("typing")))
+                    
+            elif message_type == "mark_read":
+                nickname = self.nicknames.get(websocket)
+                seq = data.get("seq")
+                room_id = self.user_rooms.get(websocket)
+                if isinstance(seq, int) and not isinstance(seq, bool):
+                    if room_id:
+                        shard = self.shards.shard_for(room_id)
+                        shard.submit(shard.mark_read, room_id, websocket, seq)
+                    elif nickname and 0 < seq <= self.room_seq.get(LOBBY_ROOM, 0):
+                        self.presence.mark_read(LOBBY_ROOM, nickname, seq)
+                
         except Exception as e:
             logger.error(f"Error handling message: {e}")
-            await websocket.send(json.dumps({
+            await self.send_json(websocket, {
                 "type": "error",
                 "message": "Server error"
-            }))
+            })
     
-    async def handle_encrypted_message(self, websocket, data, nickname):
-        """Handle encrypted chat messages"""
+    async def handle_encrypted_message(self, websocket, data, nickname, room_id=LOBBY_ROOM):
+        """Handle encrypted chat messages, for the lobby or a match room"""
         try:
             encrypted_content = data.get("encrypted_content")
-            if not encrypted_content or not self.room_key:
-                await websocket.send(json.dumps({
+            current_key = self.room_keys.current_key(room_id)
+            if not encrypted_content or not current_key:
+                await self.send_json(websocket, {
                     "type": "error",
                     "message": "Encryption not properly initialized"
-                }))
+                })
                 return
             
-            # Verify message signature if present
+            # Verify message signature if present (in the pool - HMAC over a
+            # large payload would otherwise stall every connection). Only a
+            # verified signature lets the client's key id through to recipients.
+            key_id = current_key.key_id
             if "signature" in data:
-                message_str = json.dumps(encrypted_content, sort_keys=True)
-                if not self.security_manager.verify_message_signature(
-                    message_str, data["signature"], self.room_key
+                await self.flush_current_outbox()  # The pool may make us wait
+                key_id = data.get("key_id") or key_id
+                # The key id names the exact key; no trying each valid version
+                signing_key = self.room_keys.signing_key(key_id, room_id)
+                if signing_key is None:
+                    await self.send_json(websocket, {
+                        "type": "error",
+                        "message": "Unknown or expired room key"
+                    })
+                    return
+                if not await self.crypto_pool.run(
+                    verify_signature, self.security_manager,
+                    encrypted_content, data["signature"], signing_key
                 ):
-                    await websocket.send(json.dumps({
+                    await self.send_json(websocket, {
                         "type": "error",
                         "message": "Message integrity check failed"
-                    }))
+                    })
                     return
             
+            encrypted = {
+                "encrypted_content": encrypted_content,
+                "signature": data.get("signature"),
+                "key_id": key_id
+            }
+            if room_id != LOBBY_ROOM:
+                await self.room_call(room_id, "room_message", room_id, websocket, None, encrypted)
+                return
+            
             # Broadcast encrypted message (relay without decrypting server-side)
             await self.broadcast_message({
                 "type": "encrypted_chat_message",
                 "nickname": nickname,
-                "encrypted_content": encrypted_content,
                 "timestamp": datetime.now().isoformat(),
-                "signature": data.get("signature")
+                "seq": self.next_seq(LOBBY_ROOM),
+                **encrypted
             })
             
         except Exception as e:
             logger.error(f"Error handling encrypted message: {e}")
-            await websocket.send(json.dumps({
+            await self.send_json(websocket, {
                 "type": "error",
                 "message": "Failed to process encrypted message"
-            }))
+            })
     
-    async def initialize_room_encryption(self, websocket):
+    async def initialize_room_encryption(self, websocket, room_id=LOBBY_ROOM):
         """Initialize room-level encryption"""
-        if not self.room_key:
-            self.room_key = self.security_manager.generate_room_key()
+        key = self.room_keys.current_key(room_id)
+        if key is None:
+            await self.flush_current_outbox()  # The pool may make us wait
+            secret = await self.crypto_pool.run(self.security_manager.generate_room_key)
+            key = self.room_keys.ensure(room_id, secret)  # Another client may have won
+        await self.send_room_key(websocket, key)
         
-        # Send room key to client (in real implementation, use key exchange protocol)
-        await websocket.send(json.dumps({
+    async def send_room_key(self, websocket, key):
+        """Send a client the signing key for one key version, never the secret"""
+        # In real implementation, use key exchange protocol
+        await self.send_json(websocket, {
             "type": "room_key",
-            "key": self.room_key.hex()
-        }))
+            "room_id": None if key.room_id == LOBBY_ROOM else key.room_id,
+            "key_id": key.key_id,
+            "key": key.derive_signing_key().hex()
+        })
+        
+    async def run_key_rotation(self, interval=60):
+        """Rotate room keys on schedule and hand members the new version"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                for room_id in self.room_keys.due_for_rotation():
+                    secret = await self.crypto_pool.run(self.security_manager.generate_room_key)
+                    key = self.room_keys.rotate(room_id, secret)
+                    if room_id == LOBBY_ROOM:
+                        members = list(self.nicknames)
+                    else:
+                        members = [ws for ws, room in self.user_rooms.items() if room == room_id]
+                    for websocket in members:
+                        try:
+                            await self.send_room_key(websocket, key)
+                        except websockets.exceptions.ConnectionClosed:
+                            pass
+                    logger.info(f"Rotated key for {room_id} to {key.key_id}")
+                self.room_keys.prune()
+            except Exception as e:
+                logger.error(f"Error rotating room keys: {e}")
     
     # Matchmaking System Methods
     async def join_matchmaking_queue(self, websocket):
         """Add user to matchmaking queue"""
         nickname = self.nicknames.get(websocket)
         if not nickname:
-            await websocket.send(json.dumps({
+            await self.send_json(websocket, {
                 "type": "error",
                 "message": "Please set a nickname first"
-            }))
+            })
             return
             
         # Check if user is already in queue
         if websocket in self.matchmaking_queue:
-            await websocket.send(json.dumps({
+            await self.send_json(websocket, {
                 "type": "error", 
                 "message": "You are already in the matchmaking queue"
-            }))
+            })
             return
             
         # Check if user is already in a room
         if websocket in self.user_rooms:
-            await websocket.send(json.dumps({
+            await self.send_json(websocket, {
                 "type": "error",
                 "message": "You are already in a match room"
-            }))
+            })
             return
             
         # Add to queue
         self.matchmaking_queue.append(websocket)
         logger.info(f"User {nickname} joined matchmaking queue. Queue size: {len(self.matchmaking_queue)}")
         
-        await websocket.send(json.dumps({
+        await self.send_json(websocket, {
             "type": "matchmaking_joined",
             "queue_position": len(self.matchmaking_queue),
             "message": f"Joined matchmaking queue (position {len(self.matchmaking_queue)})"
-        }))
+        })
         
         # Try to create a match
         await self.try_create_match()
@@ -381,10 +663,10 @@ class ChatServer:
             nickname = self.nicknames.get(websocket, "Unknown")
             logger.info(f"User {nickname} left matchmaking queue. Queue size: {len(self.matchmaking_queue)}")
             
-            await websocket.send(json.dumps({
+            await self.send_json(websocket, {
                 "type": "matchmaking_left",
                 "message": "Left matchmaking queue"
-            }))
+            })
             
             # Update queue positions for remaining users
             await self.update_queue_positions()
@@ -401,13 +683,6 @@ class ChatServer:
             room_id = f"match_{self.room_counter}"
             room_name = f"Match Room {self.room_counter}"
             
-            # Set up room
-            self.active_rooms[room_id] = {
-                "users": [user1, user2],
-                "room_name": room_name,
-                "created_at": datetime.now().isoformat()
-            }
-            
             # Map users to room
             self.user_rooms[user1] = room_id
             self.user_rooms[user2] = room_id
@@ -418,29 +693,15 @@ class ChatServer:
             
             logger.info(f"Match created: {nickname1} vs {nickname2} in {room_name}")
             
-            # Notify both users about the match
-            match_message = {
-                "type": "match_found",
-                "room_id": room_id,
-                "room_name": room_name,
-                "opponent": "",
-                "message": "Match found! You've been placed in a private room."
-            }
-            
-            # Send to user1 with user2's nickname as opponent
-            match_message["opponent"] = nickname2
-            await user1.send(json.dumps(match_message))
+            # The owning shard sets up the room and notifies both users
+            await self.room_call(room_id, "create_room", room_id, room_name, [
+                (user1, nickname1, self.client_encodings.get(user1)),
+                (user2, nickname2, self.client_encodings.get(user2))
+            ])
             
-            # Send to user2 with user1's nickname as opponent
-            match_message["opponent"] = nickname1
-            await user2.send(json.dumps(match_message))
-            
-            # Send welcome message to the room
-            await self.broadcast_to_room(room_id, {
-                "type": "system_message",
-                "message": f"Welcome to {room_name}! {nickname1} and {nickname2} have been matched.",
-                "timestamp": datetime.now().isoformat()
-            })
+            # Each match room has its own keys
+            for websocket in (user1, user2):
+                await self.initialize_room_encryption(websocket, room_id)
             
             # Update queue positions for remaining users
             await self.update_queue_positions()
@@ -452,118 +713,73 @@ class ChatServer:
             return
             
         nickname = self.nicknames.get(websocket, "Unknown")
-        room = self.active_rooms.get(room_id)
         
-        if room:
-            # Remove user from room
-            if websocket in room["users"]:
-                room["users"].remove(websocket)
-                
-            # Notify other user in room
-            await self.broadcast_to_room(room_id, {
-                "type": "opponent_left",
-                "message": f"{nickname} has left the room",
-                "timestamp": datetime.now().isoformat()
-            }, exclude=websocket)
-            
-            # If room is empty, remove it
-            if len(room["users"]) == 0:
-                del self.active_rooms[room_id]
-                logger.info(f"Room {room_id} deleted (empty)")
-            
         # Remove user from room mapping
         del self.user_rooms[websocket]
         logger.info(f"User {nickname} left room {room_id}")
-    
-    async def broadcast_to_room(self, room_id, message, exclude=None):
-        """Broadcast message to all users in a specific room"""
-        room = self.active_rooms.get(room_id)
-        if not room:
-            return
+        
+        if room_id not in self.user_rooms.values():
+            self.room_keys.drop(room_id)
             
-        message_str = json.dumps(message)
-        disconnected = set()
+        # The shard notifies the other user and deletes the room once empty
+        await self.room_call(room_id, "leave_room", room_id, websocket)
+    
+    def next_seq(self, room_id):
+        """Next message sequence number in a room, for read receipts"""
+        self.room_seq[room_id] = self.room_seq.get(room_id, 0) + 1
+        return self.room_seq[room_id]
         
-        for websocket in room["users"]:
-            if websocket == exclude:
-                continue
-                
-            try:
-                await websocket.send(message_str)
-            except websockets.exceptions.ConnectionClosed:
-                disconnected.add(websocket)
-        
-        # Clean up disconnected clients from room
-        for websocket in disconnected:
-            if websocket in room["users"]:
-                room["users"].remove(websocket)
-            if websocket in self.user_rooms:
-                del self.user_rooms[websocket]
+    async def run_presence_loop(self, interval=PRESENCE_INTERVAL):
+        """Push main chat typing/read snapshots at a fixed rate, only on change"""
+        # Match rooms run their own presence loops on their shards
+        while True:
+            await asyncio.sleep(interval)
+            for _, snapshot in self.presence.collect_changes():
+                try:
+                    # The hub only tracks the lobby; clients know it as room_id null
+                    await self.broadcast_message({"type": "presence", "room_id": None, **snapshot})
+                except Exception as e:
+                    logger.error(f"Error pushing presence: {e}")
     
     async def send_room_message(self, websocket, content):
         """Send message to room (only room members can see it)"""
         room_id = self.user_rooms.get(websocket)
         if not room_id:
-            await websocket.send(json.dumps({
+            await self.send_json(websocket, {
                 "type": "error",
                 "message": "You are not in a room"
-            }))
+            })
             return
             
-        nickname = self.nicknames.get(websocket, "Unknown")
-        
-        # Broadcast to room members only
-        await self.broadcast_to_room(room_id, {
-            "type": "room_message",
-            "room_id": room_id,
-            "nickname": nickname,
-            "content": content,
-            "timestamp": datetime.now().isoformat()
-        })
+        # Broadcast to room members only, from the room's shard
+        await self.room_call(room_id, "room_message", room_id, websocket, content)
     
     async def update_queue_positions(self):
         """Update queue positions for all users in queue"""
         for i, websocket in enumerate(self.matchmaking_queue):
-            await websocket.send(json.dumps({
+            await self.send_json(websocket, {
                 "type": "queue_update",
                 "position": i + 1,
                 "total_in_queue": len(self.matchmaking_queue)
-            }))
+            })
     
     async def get_room_info(self, websocket):
         """Get information about user's current room"""
         room_id = self.user_rooms.get(websocket)
         if not room_id:
-            await websocket.send(json.dumps({
+            await self.send_json(websocket, {
                 "type": "room_info",
                 "in_room": False
-            }))
+            })
             return
             
-        room = self.active_rooms.get(room_id)
-        if not room:
+        if not await self.room_call(room_id, "room_info", room_id, websocket):
             # Clean up stale room mapping
-            del self.user_rooms[websocket]
-            await websocket.send(json.dumps({
+            self.user_rooms.pop(websocket, None)
+            await self.send_json(websocket, {
                 "type": "room_info", 
                 "in_room": False
-            }))
-            return
-            
-        # Get room members' nicknames
-        members = []
-        for user_ws in room["users"]:
-            nickname = self.nicknames.get(user_ws, "Unknown")
-            members.append(nickname)
-            
-        await websocket.send(json.dumps({
-            "type": "room_info",
-            "in_room": True,
-            "room_id": room_id,
-            "room_name": room["room_name"],
-            "members": members,
-            "created_at": room["created_at"]
-        }))
+            })
         
     async def cleanup_user_matchmaking_data(self, websocket):
         """Clean up all matchmaking and room data for a disconnected user"""
@@ -579,18 +795,22 @@ class ChatServer:
         if websocket in self.user_rooms:
             await self.leave_room(websocket)
 
-    async def validate_client_input(self, websocket, data):
-        """Validate client input for security"""
-        client_ip = websocket.remote_address[0] if websocket.remote_address else "unknown"
+    def check_message(self, client_ip, message_data):
+        """Parse and validate a raw frame; returns (data, error message)"""
+        try:
+            # Secure JSON parsing with size limits
+            data = self.security_manager.secure_json_loads(message_data)
+        except json.JSONDecodeError:
+            return None, "Invalid message format"
+        except Exception as e:
+            logger.error(f"Error parsing message: {e}")
+            return None, "Server error"
+        if not isinstance(data, dict):
+            return None, "Invalid message format"
         
         # Rate limiting check
         if not self.security_manager.check_rate_limit(client_ip):
-            await websocket.send(json.dumps({
-                "type": "error",
-                "message": "Too many requests. Please slow down."
-            }))
-            await websocket.close(code=1008, reason="Rate limit exceeded")
-            return False
+            return None, RATE_LIMIT_ERROR
         
         # Input validation
         for key, value in data.items():
@@ -598,27 +818,205 @@ class ChatServer:
                 self.security_manager.log_security_event(
                     "INVALID_INPUT", client_ip, f"Key: {key}, Value: {value[:100]}"
                 )
-                await websocket.send(json.dumps({
-                    "type": "error",
-                    "message": "Invalid input detected"
-                }))
-                return False
+                return None, "Invalid input detected"
         
+        return data, None
+        
+    async def close_client(self, websocket, code, reason):
+        """Close a connection after sending anything it is still owed"""
+        outbox = current_outbox.get()
+        if outbox is not None:
+            await self.flush_outbox(outbox, websocket)
+        await websocket.close(code=code, reason=reason)
+            
+    async def drain(self, ws_server, reconnect_after=1, timeout=10):
+        """Stop accepting, hand clients resume tokens and snapshot their sessions"""
+        self.draining = True
+        ws_server.server.close()  # Stop listening; open connections stay up
+        logger.info(f"Draining {len(self.clients)} clients")
+        
+        sessions = {}
+        for websocket in list(self.clients):
+            nickname = self.nicknames.get(websocket)
+            if not nickname:
+                continue
+                
+            token = new_resume_token()
+            queue_position = None
+            if websocket in self.matchmaking_queue:
+                queue_position = self.matchmaking_queue.index(websocket) + 1
+            sessions[token] = {
+                "nickname": nickname,
+                "room_id": self.user_rooms.get(websocket),
+                "queue_position": queue_position
+            }
+            
+            try:
+                await self.send_json(websocket, {
+                    "type": "server_draining",
+                    "resume_token": token,
+                    "reconnect_after": reconnect_after
+                })
+            except websockets.exceptions.ConnectionClosed:
+                del sessions[token]
+        
+        rooms = await self.shards.room_metadata()
+        write_snapshot(sessions, rooms, self.room_counter)
+        
+        # Closing flushes anything still queued on each connection first
+        closing = [
+            asyncio.ensure_future(websocket.close(code=1012, reason="Server restarting"))
+            for websocket in list(self.clients)
+        ]
+        if closing:
+            await asyncio.wait(closing, timeout=timeout)
+        
+    def restore_snapshot(self, snapshot):
+        """Load sessions written by a draining predecessor"""
+        self.room_counter = max(self.room_counter, snapshot["room_counter"])
+        self.resumable_sessions = snapshot["sessions"]
+        self.restored_rooms = snapshot["rooms"]
+        self.resume_expires_at = snapshot["expires_at"]
+        logger.info(f"Restored {len(self.resumable_sessions)} resumable sessions")
+        
+    async def resume_session(self, websocket, token):
+        """Reattach a reconnecting client to its pre-restart session"""
+        session = self.resumable_sessions.pop(token, None)
+        if (not session or time.time() > self.resume_expires_at
+                or session["nickname"] in self.nicknames.values()):
+            await self.send_json(websocket, {
+                "type": "resume_failed",
+                "message": "Session expired, please rejoin"
+            })
+            return False
+            
+        # No user_joined per resumed session; one user_list covers the burst
+        nickname = session["nickname"]
+        self.nicknames[websocket] = nickname
+        self.schedule_user_list()
+        
+        room_id = session.get("room_id")
+        room_name = None
+        if room_id:
+            # The shard recreates the room from its snapshot metadata if needed
+            shard = self.shards.shard_for(room_id)
+            room_name = await shard.call(
+                shard.rejoin_room, room_id, websocket, nickname,
+                self.client_encodings.get(websocket), self.restored_rooms.pop(room_id, None)
+            )
+            if room_name is not None:
+                self.user_rooms[websocket] = room_id
+                
+        queue_position = session.get("queue_position")
+        if queue_position and room_name is None:
+            # Keep the pre-restart order among resumed clients; anyone who
+            # joined after the restart queues behind them
+            self.resumed_positions[websocket] = queue_position
+            index = len(self.matchmaking_queue)
+            for i, queued in enumerate(self.matchmaking_queue):
+                if self.resumed_positions.get(queued, float("inf")) > queue_position:
+                    index = i
+                    break
+            self.matchmaking_queue.insert(index, websocket)
+            
+        logger.info(f"Resumed session for {nickname}")
+        await self.send_json(websocket, {
+            "type": "nickname_set",
+            "nickname": nickname
+        })
+        await self.send_json(websocket, {
+            "type": "session_resumed",
+            "nickname": nickname,
+            "room_id": self.user_rooms.get(websocket),
+            "room_name": room_name,
+            "queue_position": (self.matchmaking_queue.index(websocket) + 1
+                               if websocket in self.matchmaking_queue else None)
+        })
+        
+        # Keys are not persisted; the lobby and the room start fresh keyrings
+        await self.initialize_room_encryption(websocket)
+        if websocket in self.user_rooms:
+            await self.initialize_room_encryption(websocket, self.user_rooms[websocket])
+        if websocket in self.matchmaking_queue:
+            await self.try_create_match()
         return True
             
+    def schedule_user_list(self):
+        """Broadcast the user list once RESUME_USER_LIST_DELAY has passed"""
+        if self.user_list_scheduled:
+            return
+        self.user_list_scheduled = True
+        # Fresh context: the broadcast must not land in a caller's batch outbox
+        asyncio.get_running_loop().call_later(
+            RESUME_USER_LIST_DELAY,
+            lambda: asyncio.ensure_future(self.broadcast_user_list()),
+            context=contextvars.Context()
+        )
+        
+    async def broadcast_user_list(self):
+        self.user_list_scheduled = False
+        await self.broadcast_message({
+            "type": "user_list",
+            "users": list(self.nicknames.values())
+        })
+        
     async def handle_client(self, websocket, path):
         """Handle a client connection"""
-        await self.register_client(websocket)
+        if self.draining:
+            await websocket.close(code=1012, reason="Server restarting")
+            return
+            
+        # Admission is checked before any per-client state is allocated
+        client_ip = get_client_ip(websocket)
+        rejection = self.admission.admit(client_ip)
+        if rejection:
+            await websocket.close(code=CLOSE_TRY_AGAIN_LATER, reason=rejection)
+            return
+            
+        await self.register_client(websocket, path)
         try:
-            async for message in websocket:
-                await self.handle_message(websocket, message)
+            resume_token = parse_qs(urlparse(path).query).get("resume")
+            if resume_token:
+                await self.resume_session(websocket, resume_token[0])
+                
+            while True:
+                batch = [await websocket.recv()]
+                # Take whatever else has already arrived - recv() returns
+                # buffered frames without waiting
+                while len(batch) < MAX_INBOUND_BATCH and websocket.messages:
+                    batch.append(await websocket.recv())
+                await self.handle_batch(websocket, batch)
         except websockets.exceptions.ConnectionClosed:
             pass
         finally:
+            self.admission.release(client_ip)
             await self.unregister_client(websocket)
 
+def verify_signature(security_manager, encrypted_content, signature, room_key):
+    """Check a message signature; runs in a crypto pool worker"""
+    message_str = json.dumps(encrypted_content, sort_keys=True)
+    return security_manager.verify_message_signature(message_str, signature, room_key)
+
+def is_cloud_environment():
+    """Check if running on a cloud platform"""
+    return bool(os.environ.get("DYNO") or os.environ.get("RENDER") or os.environ.get("RAILWAY_ENVIRONMENT"))
+
+def get_client_ip(websocket):
+    """Get the client's IP address, as seen by the platform's proxy in the cloud"""
+    if is_cloud_environment() and TRUSTED_PROXY_HOPS > 0:
+        # Clients can send their own X-Forwarded-For; only the entries our
+        # proxies appended (rightmost) can be trusted
+        forwarded = websocket.request_headers.get("X-Forwarded-For")
+        if forwarded:
+            entries = [entry.strip() for entry in forwarded.split(",")]
+            return entries[-min(TRUSTED_PROXY_HOPS, len(entries))]
+    return websocket.remote_address[0] if websocket.remote_address else "unknown"
+
 def get_local_ip():
     """Get the local IP address"""
+    if is_cloud_environment():
+        # No LAN to advertise in the cloud - skip the network probe
+        return "127.0.0.1"
     try:
         # Connect to a remote address to determine local IP
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
@@ -627,17 +1025,18 @@ def get_local_ip():
     except Exception:
         return "127.0.0.1"
 
-async def main():
-    server = ChatServer()
-    host = "0.0.0.0"  # Listen on all interfaces
-    
-    # Use environment variables for cloud deployment
-    ws_port = int(os.environ.get("PORT", 8765))  # Cloud platforms use PORT env var
-    http_port = int(os.environ.get("HTTP_PORT", ws_port + 1))
-    
-    # Check if running in cloud environment
-    is_cloud = os.environ.get("DYNO") or os.environ.get("RENDER") or os.environ.get("RAILWAY_ENVIRONMENT")
-    
+async def warm_up_subsystems():
+    """Import deferred modules in a worker thread once the server is accepting"""
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, importlib.import_module, "secure_server")
+    except Exception as e:
+        # No message can be handled without it; fail like a startup crash
+        logger.error(f"Failed to load security module: {e}")
+        raise
+
+def announce_server(is_cloud, ws_port, http_port):
+    """Start discovery (local only) and print the startup banner"""
     if not is_cloud:
         # Local deployment - keep existing discovery functionality
         server_name = socket.gethostname()
@@ -690,14 +1089,58 @@ async def main():
         print("=" * 60)
     print("Press Ctrl+C to stop the server")
     print("=" * 60)
+
+async def main():
+    server = ChatServer()
+    host = "0.0.0.0"  # Listen on all interfaces
+    
+    # Use environment variables for cloud deployment
+    ws_port = int(os.environ.get("PORT", 8765))  # Cloud platforms use PORT env var
+    http_port = int(os.environ.get("HTTP_PORT", ws_port + 1))
+    
+    # Check if running in cloud environment
+    is_cloud = is_cloud_environment()
+    
+    # Pick up sessions from a predecessor that drained for a restart
+    snapshot = load_snapshot()
+    if snapshot:
+        server.restore_snapshot(snapshot)
+    
+    # SIGTERM (sent by the platform on redeploy) drains instead of dropping
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, lambda: stop.done() or stop.set_result(None))
+    except (NotImplementedError, AttributeError):
+        pass  # Not supported on Windows
     
     try:
-        async with websockets.serve(server.handle_client, host, ws_port):
-            await asyncio.Future()  # Run forever
+        # Transport-level permessage-deflate is disabled: it deflates every
+        # tiny frame per connection. Large frames are compressed selectively
+        # by the frame encoder instead.
+        async with websockets.serve(server.handle_client, host, ws_port, compression=None) as ws_server:
+            logger.info(f"Accepting connections {time.perf_counter() - PROCESS_START:.3f}s after start")
+            
+            # Non-critical startup runs after the socket is already accepting
+            warm_up = asyncio.create_task(warm_up_subsystems())
+            server.shards.start()
+            presence = asyncio.create_task(server.run_presence_loop())
+            key_rotation = asyncio.create_task(server.run_key_rotation())
+            announce_server(is_cloud, ws_port, http_port)
+            
+            # Run until asked to restart; stop at once if warm-up fails
+            await asyncio.wait([stop, warm_up], return_when=asyncio.FIRST_COMPLETED)
+            if warm_up.done():
+                if warm_up.exception() is not None:
+                    print("❌ Server error: security module unavailable, shutting down")
+                    raise SystemExit(1)
+                await stop
+            await server.drain(ws_server)
+            server.crypto_pool.shutdown()
     except KeyboardInterrupt:
         print("\n🛑 Server stopped by user")
     except Exception as e:
         print(f"❌ Server error: {e}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Session Snapshot
+Persists client sessions across a restart so reconnecting clients can resume
+(nickname, match room, matchmaking position) without a full re-join.
+"""
+
+import json
+import logging
+import os
+import secrets
+import time
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = os.environ.get("SESSION_SNAPSHOT_PATH", "session_snapshot.json")
+RESUME_TTL = int(os.environ.get("SESSION_RESUME_TTL", 120))  # seconds
+
+
+def new_resume_token():
+    """Generate an unguessable, single-use resume token"""
+    return secrets.token_urlsafe(24)
+
+
+def write_snapshot(sessions, rooms, room_counter, path=SNAPSHOT_PATH):
+    """Atomically write sessions (token -> session) and room metadata"""
+    snapshot = {
+        "written_at": time.time(),
+        "room_counter": room_counter,
+        "sessions": sessions,
+        "rooms": rooms
+    }
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(temp_path, path)
+    logger.info(f"Wrote session snapshot with {len(sessions)} sessions to {path}")
+
+
+def load_snapshot(path=SNAPSHOT_PATH):
+    """Load and consume a snapshot; returns None if missing or expired"""
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error(f"Ignoring unreadable session snapshot {path}: {e}")
+        return None
+    finally:
+        # Tokens are single use - never restore the same snapshot twice
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    age = time.time() - snapshot.get("written_at", 0)
+    if age > RESUME_TTL:
+        logger.info(f"Discarding session snapshot ({age:.0f}s old)")
+        return None
+
+    snapshot["expires_at"] = snapshot["written_at"] + RESUME_TTL
+    return snapshot
@@ -3,6 +3,7 @@ import './App.css';
 import NicknameForm from './components/NicknameForm';
 import ServerSelection from './components/ServerSelection';
 import ChatRoom from './components/ChatRoom';
+import FrameDecoder from './utils/FrameDecoder';
 
 const App = () => {
   const [currentScreen, setCurrentScreen] = useState('nickname'); // 'nickname', 'server', 'chat'
@@ -12,39 +13,94 @@ const App = () => {
   const [serverUrl, setServerUrl] = useState('');
   const [connectionError, setConnectionError] = useState('');
   const wsRef = useRef(null);
+  const resumeRef = useRef(null); // Resume token handed out by a draining server
+  const connectRef = useRef(null);
+  const retryAttemptRef = useRef(0);
+  const retryTimerRef = useRef(null);
 
-  const connectToServer = useCallback((url) => {
+  const connectToServer = useCallback((url, resumeToken = null) => {
     setConnectionError('');
     setServerUrl(url);
     
     try {
-      const websocket = new WebSocket(url);
+      const connectUrl = new URL(FrameDecoder.withCapabilities(url));
+      if (resumeToken) {
+        connectUrl.searchParams.set('resume', resumeToken);
+      }
+      const websocket = new WebSocket(connectUrl.toString());
+      const decoder = new FrameDecoder();
       wsRef.current = websocket;
       
+      const sendNickname = () => {
+        websocket.send(JSON.stringify({
+          type: 'set_nickname',
+          nickname: nickname
+        }));
+      };
+      
       websocket.onopen = () => {
         console.log('Connected to server');
         setWs(websocket);
         setConnected(true);
         
-        // Set nickname on server
-        websocket.send(JSON.stringify({
-          type: 'set_nickname',
-          nickname: nickname
-        }));
+        // A resumed session is restored server-side without a re-join
+        if (!resumeToken) {
+          sendNickname();
+        }
       };
 
       websocket.onmessage = (event) => {
-        const data = JSON.parse(event.data);
-        
-        if (data.type === 'nickname_set') {
-          setCurrentScreen('chat');
-        } else if (data.type === 'error') {
-          setConnectionError(data.message);
-          websocket.close();
-        }
+        decoder.decode(event.data, (data) => {
+          if (data.type === 'nickname_set') {
+            retryAttemptRef.current = 0;
+            setCurrentScreen('chat');
+          } else if (data.type === 'server_draining') {
+            resumeRef.current = {
+              token: data.resume_token,
+              delay: data.reconnect_after
+            };
+          } else if (data.type === 'resume_failed') {
+            sendNickname();
+          } else if (data.type === 'error') {
+            setConnectionError(data.message);
+            websocket.close();
+          }
+        });
       };
 
-      websocket.onclose = () => {
+      websocket.onclose = (event) => {
+        if (event.code === 1013) {
+          // Server is overloaded: wait at least its retry_after hint, plus
+          // exponential backoff with full jitter so clients don't retry in sync
+          let retryAfter = 2;
+          try {
+            retryAfter = JSON.parse(event.reason).retry_after || retryAfter;
+          } catch {
+            // Reason wasn't JSON - keep the default hint
+          }
+          const attempt = Math.min(retryAttemptRef.current, 5);
+          retryAttemptRef.current += 1;
+          const backoff = Math.random() * 1000 * Math.pow(2, attempt);
+          const delay = retryAfter * 1000 + backoff;
+          setConnectionError(`Server is busy. Retrying in ${Math.ceil(delay / 1000)}s...`);
+          retryTimerRef.current = setTimeout(() => {
+            connectRef.current(url, resumeToken);
+          }, delay);
+          return;
+        }
+        
+        const resume = resumeRef.current;
+        if (resume) {
+          // Server is restarting: reconnect to the new process and resume,
+          // spreading clients out over a second so it isn't hit all at once
+          resumeRef.current = null;
+          console.log('Server restarting, resuming session');
+          setTimeout(() => {
+            connectRef.current(url, resume.token);
+          }, (resume.delay + Math.random()) * 1000);
+          return;
+        }
+        
         console.log('Disconnected from server');
         setWs(null);
         setConnected(false);
@@ -64,6 +120,7 @@ const App = () => {
       setConnectionError('Invalid server URL. Please check and try again.');
     }
   }, [nickname, currentScreen]);
+  connectRef.current = connectToServer;
 
   const handleNicknameSubmit = (submittedNickname) => {
     setNickname(submittedNickname);
@@ -71,6 +128,8 @@ const App = () => {
   };
 
   const disconnect = () => {
+    resumeRef.current = null;
+    clearTimeout(retryTimerRef.current);
     if (wsRef.current) {
       wsRef.current.close();
     }
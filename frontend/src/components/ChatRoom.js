@@ -1,7 +1,13 @@
 import React, { useState, useEffect, useRef, useCallback } from 'react';
 import SecureMessaging from '../utils/SecureMessaging';
+import FrameDecoder from '../utils/FrameDecoder';
+import VoiceSignaling from '../utils/VoiceSignaling';
 // import VoiceChat from './VoiceChat';
 
+const TYPING_REFRESH_MS = 2000; // Re-send "typing" at most this often
+const TYPING_IDLE_MS = 3000; // Stop typing after this long without input
+const READ_REPORT_MS = 1000; // Coalesce read receipts over this window
+
 const ChatRoom = ({ ws, nickname, serverUrl, onDisconnect }) => {
   const [messages, setMessages] = useState([]);
   const [inputMessage, setInputMessage] = useState('');
@@ -19,8 +25,19 @@ const ChatRoom = ({ ws, nickname, serverUrl, onDisconnect }) => {
   const [roomInfo, setRoomInfo] = useState(null);
   // const [isInMatchMode, setIsInMatchMode] = useState(false);
   
+  // Typing indicators and read receipts
+  const [typingUsers, setTypingUsers] = useState([]);
+  const [readReceipts, setReadReceipts] = useState({});
+  const currentRoomRef = useRef(null);
+  const typingSentRef = useRef(0);
+  const typingTimerRef = useRef(null);
+  const lastSeqRef = useRef(0);
+  const readTimerRef = useRef(null);
+  
   const messagesEndRef = useRef(null);
   const secureMessaging = useRef(new SecureMessaging());
+  const frameDecoder = useRef(new FrameDecoder());
+  const voiceSignaling = useRef(null);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
@@ -32,12 +49,35 @@ const ChatRoom = ({ ws, nickname, serverUrl, onDisconnect }) => {
     scrollToBottom();
   }, [messages]);
 
+  useEffect(() => {
+    // Presence snapshots are per room; a new room starts with a clean slate
+    currentRoomRef.current = inRoom && roomInfo ? roomInfo.room_id : null;
+    setTypingUsers([]);
+    setReadReceipts({});
+    lastSeqRef.current = 0;
+  }, [inRoom, roomInfo]);
+
   useEffect(() => {
     if (!ws) return;
 
-    const handleMessage = (event) => {
-      const data = JSON.parse(event.data);
-      
+    if (!voiceSignaling.current || voiceSignaling.current.ws !== ws) {
+      voiceSignaling.current = new VoiceSignaling(ws);
+    }
+
+    const reportRead = (seq) => {
+      // One mark_read per window, carrying the newest sequence number
+      if (!seq || seq <= lastSeqRef.current) return;
+      lastSeqRef.current = seq;
+      if (readTimerRef.current) return;
+      readTimerRef.current = setTimeout(() => {
+        readTimerRef.current = null;
+        if (ws.readyState === WebSocket.OPEN) {
+          ws.send(JSON.stringify({ type: 'mark_read', seq: lastSeqRef.current }));
+        }
+      }, READ_REPORT_MS);
+    };
+
+    const handleFrame = (data) => {
       switch (data.type) {
         case 'chat_message':
           setMessages(prev => [...prev, {
@@ -46,8 +86,10 @@ const ChatRoom = ({ ws, nickname, serverUrl, onDisconnect }) => {
             content: data.content,
             timestamp: data.timestamp,
             isOwn: data.nickname === nickname,
-            encrypted: false
+            encrypted: false,
+            seq: data.seq
           }]);
+          reportRead(data.seq);
           break;
           
         case 'encrypted_chat_message':
@@ -79,8 +121,10 @@ const ChatRoom = ({ ws, nickname, serverUrl, onDisconnect }) => {
               timestamp: data.timestamp,
               isOwn: data.nickname === nickname,
               encrypted: true,
-              decryptionFailed: decryptionFailed
+              decryptionFailed: decryptionFailed,
+              seq: data.seq
             }]);
+            reportRead(data.seq);
           } catch (e) {
             console.error('Error processing encrypted message:', e);
           }
@@ -178,8 +222,10 @@ const ChatRoom = ({ ws, nickname, serverUrl, onDisconnect }) => {
             timestamp: data.timestamp,
             isOwn: data.nickname === nickname,
             encrypted: false,
-            isRoomMessage: true
+            isRoomMessage: true,
+            seq: data.seq
           }]);
+          reportRead(data.seq);
           break;
 
         case 'opponent_left':
@@ -198,12 +244,76 @@ const ChatRoom = ({ ws, nickname, serverUrl, onDisconnect }) => {
             timestamp: data.timestamp
           }]);
           break;
+
+        case 'server_draining':
+          setMessages(prev => [...prev, {
+            type: 'system',
+            content: '🔄 Server is restarting, reconnecting...',
+            timestamp: new Date().toISOString()
+          }]);
+          break;
+
+        case 'session_resumed':
+          setInRoom(Boolean(data.room_id));
+          if (!data.room_id) {
+            setRoomInfo(null);
+          }
+          setInMatchmakingQueue(Boolean(data.queue_position));
+          setQueuePosition(data.queue_position || 0);
+          setMessages(prev => [...prev, {
+            type: 'system',
+            content: '✅ Reconnected',
+            timestamp: new Date().toISOString()
+          }]);
+          break;
+
+        case 'presence':
+          if (data.room_id !== currentRoomRef.current) break;
+          setTypingUsers(data.typing.filter(user => user !== nickname));
+          setReadReceipts(data.read);
+          break;
+
+        case 'voice_session':
+          voiceSignaling.current.handleSession(data);
+          break;
+
+        case 'voice_user_joined':
+          voiceSignaling.current.handleUserJoined(data);
+          break;
+
+        case 'voice_user_left':
+          voiceSignaling.current.handleUserLeft(data);
+          break;
+
+        case 'voice_offer':
+          voiceSignaling.current.handleOffer(data);
+          break;
+
+        case 'voice_answer':
+          voiceSignaling.current.handleAnswer(data);
+          break;
+
+        case 'voice_ice_candidates':
+          voiceSignaling.current.handleCandidates(data);
+          break;
+
+        case 'voice_join_rejected':
+          setMessages(prev => [...prev, {
+            type: 'system',
+            content: `Voice: ${data.reason}`,
+            timestamp: new Date().toISOString()
+          }]);
+          break;
           
         default:
           console.log('Unknown message type:', data.type);
       }
     };
 
+    const handleMessage = (event) => {
+      frameDecoder.current.decode(event.data, handleFrame);
+    };
+
     ws.addEventListener('message', handleMessage);
     
     // Set nickname and request user list
@@ -212,6 +322,8 @@ const ChatRoom = ({ ws, nickname, serverUrl, onDisconnect }) => {
 
     return () => {
       ws.removeEventListener('message', handleMessage);
+      clearTimeout(readTimerRef.current);
+      readTimerRef.current = null;
     };
   }, [ws, nickname, encryptionEnabled, encryptionPassword]);
 
@@ -243,11 +355,37 @@ const ChatRoom = ({ ws, nickname, serverUrl, onDisconnect }) => {
     // setIsInMatchMode(false);
   };
 
+  const sendTyping = (isTyping) => {
+    if (ws && ws.readyState === WebSocket.OPEN) {
+      ws.send(JSON.stringify({ type: 'typing', typing: isTyping }));
+    }
+  };
+
+  const handleInputChange = (e) => {
+    setInputMessage(e.target.value);
+    
+    // Throttled: the server aggregates and pushes typing state itself
+    const now = Date.now();
+    if (now - typingSentRef.current > TYPING_REFRESH_MS) {
+      typingSentRef.current = now;
+      sendTyping(true);
+    }
+    clearTimeout(typingTimerRef.current);
+    typingTimerRef.current = setTimeout(() => {
+      typingSentRef.current = 0;
+      sendTyping(false);
+    }, TYPING_IDLE_MS);
+  };
+
   const sendMessage = (e) => {
     e.preventDefault();
     const message = inputMessage.trim();
     
     if (message && ws) {
+      // Sending a message clears the typing flag server-side
+      clearTimeout(typingTimerRef.current);
+      typingSentRef.current = 0;
+      
       try {
         // Validate and sanitize input
         const sanitizedMessage = secureMessaging.current.sanitizeInput(message);
@@ -311,6 +449,21 @@ const ChatRoom = ({ ws, nickname, serverUrl, onDisconnect }) => {
     });
   };
 
+  const formatTyping = (users) => {
+    if (users.length === 0) return '';
+    if (users.length === 1) return `${users[0]} is typing...`;
+    if (users.length <= 3) return `${users.join(', ')} are typing...`;
+    return 'Several people are typing...';
+  };
+
+  // Read receipts are shown under your most recent message
+  const lastOwnIndex = messages.reduce(
+    (last, message, index) => (message.isOwn && message.seq ? index : last), -1
+  );
+  const seenBy = lastOwnIndex === -1 ? [] : Object.keys(readReceipts).filter(
+    user => user !== nickname && readReceipts[user] >= messages[lastOwnIndex].seq
+  );
+
   const getServerAddress = (url) => {
     try {
       const wsUrl = new URL(url);
@@ -416,19 +569,28 @@ const ChatRoom = ({ ws, nickname, serverUrl, onDisconnect }) => {
                       </div>
                     </div>
                   )}
+                  {index === lastOwnIndex && seenBy.length > 0 && (
+                    <div className="read-receipt">
+                      Seen by {seenBy.join(', ')}
+                    </div>
+                  )}
                 </div>
               ))
             )}
             <div ref={messagesEndRef} />
           </div>
 
+          <div className="typing-indicator">
+            {formatTyping(typingUsers)}
+          </div>
+
           <div className="message-input-container">
             <form className="message-input-form" onSubmit={sendMessage}>
               <input
                 type="text"
                 className="message-input"
                 value={inputMessage}
-                onChange={(e) => setInputMessage(e.target.value)}
+                onChange={handleInputChange}
                 placeholder="Type your message..."
                 maxLength="500"
                 autoFocus
@@ -459,7 +621,13 @@ const ChatRoom = ({ ws, nickname, serverUrl, onDisconnect }) => {
         </div>
       </div>
 
-      {showVoiceChat && <VoiceChatModal nickname={nickname} onClose={() => setShowVoiceChat(false)} />}
+      {showVoiceChat && (
+        <VoiceChatModal
+          nickname={nickname}
+          voiceSignaling={voiceSignaling.current}
+          onClose={() => setShowVoiceChat(false)}
+        />
+      )}
 
     </div>
   );
@@ -539,13 +707,14 @@ const EncryptionSetup = ({ onEnable, onDisable, encryptionEnabled, onClose }) =>
   );
 }
 
-const VoiceChatModal = ({ nickname, onClose }) => {
+const VoiceChatModal = ({ nickname, voiceSignaling, onClose }) => {
   const [localStream, setLocalStream] = useState(null);
   const [isVideoEnabled, setIsVideoEnabled] = useState(false); // Default camera OFF
   const [isMuted, setIsMuted] = useState(false);
   const [isConnected, setIsConnected] = useState(false);
   const [permissionsGranted, setPermissionsGranted] = useState(false);
   const localVideoRef = useRef(null);
+  const streamRef = useRef(null);
 
   const startVoiceChat = async () => {
     try {
@@ -558,6 +727,9 @@ const VoiceChatModal = ({ nickname, onClose }) => {
       setLocalStream(stream);
       setIsConnected(true);
       setPermissionsGranted(true);
+      
+      // Peer connections are negotiated once the server sends voice_session
+      voiceSignaling.join(nickname, stream);
     } catch (error) {
       console.error('Error accessing microphone:', error);
       alert('Please allow microphone access to use voice chat.');
@@ -565,6 +737,7 @@ const VoiceChatModal = ({ nickname, onClose }) => {
   };
 
   const stopVoiceChat = useCallback(() => {
+    voiceSignaling.leave();
     if (localStream) {
       localStream.getTracks().forEach(track => track.stop());
     }
@@ -573,7 +746,7 @@ const VoiceChatModal = ({ nickname, onClose }) => {
     setPermissionsGranted(false);
     setIsVideoEnabled(false);
     setIsMuted(false);
-  }, [localStream]);
+  }, [localStream, voiceSignaling]);
 
   const toggleMute = () => {
     if (localStream) {
@@ -657,21 +830,30 @@ const VoiceChatModal = ({ nickname, onClose }) => {
   };
 
   useEffect(() => {
+    // Start once on mount; restarting on every stream change would
+    // re-acquire the microphone and re-join voice in a loop
     startVoiceChat();
     return () => {
       // Only cleanup when component unmounts, not on every render
-      if (localStream) {
-        localStream.getTracks().forEach(track => track.stop());
+      voiceSignaling.leave();
+      if (streamRef.current) {
+        streamRef.current.getTracks().forEach(track => track.stop());
       }
     };
-  }, [localStream]); // Include localStream in dependencies
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, []);
 
   // Separate effect to update video element when stream changes
   useEffect(() => {
+    streamRef.current = localStream;
     if (localVideoRef.current && localStream) {
       localVideoRef.current.srcObject = localStream;
     }
-  }, [localStream]);
+    if (localStream) {
+      // Existing peer connections pick up the new tracks
+      voiceSignaling.replaceStream(localStream);
+    }
+  }, [localStream, voiceSignaling]);
 
   return (
     <div style={{
@@ -0,0 +1,71 @@
+/**
+ * Decoding for frames sent by the chat server
+ * Large frames arrive as zlib-deflated binary frames; small ones as JSON text.
+ * Several messages may be combined into one {type: 'batch'} frame.
+ */
+
+class FrameDecoder {
+    constructor() {
+        // Binary frames are inflated asynchronously, so every frame goes
+        // through this chain to keep messages in the order they arrived.
+        this.tail = Promise.resolve();
+    }
+
+    /**
+     * Whether this browser can inflate compressed frames
+     * @returns {boolean} Compression support
+     */
+    static isSupported() {
+        return typeof DecompressionStream !== 'undefined';
+    }
+
+    /**
+     * Add the compression and batching offers to a server URL
+     * @param {string} url - WebSocket URL
+     * @returns {string} URL with the capability query parameters
+     */
+    static withCapabilities(url) {
+        try {
+            const wsUrl = new URL(url);
+            if (FrameDecoder.isSupported()) {
+                wsUrl.searchParams.set('encoding', 'deflate');
+            }
+            wsUrl.searchParams.set('batch', '1');
+            return wsUrl.toString();
+        } catch {
+            return url;
+        }
+    }
+
+    /**
+     * Inflate a binary frame to text
+     * @param {Blob|ArrayBuffer} payload - Compressed frame
+     * @returns {Promise<string>} JSON text
+     */
+    async inflate(payload) {
+        const blob = payload instanceof Blob ? payload : new Blob([payload]);
+        const stream = blob.stream().pipeThrough(new DecompressionStream('deflate'));
+        return new Response(stream).text();
+    }
+
+    /**
+     * Decode a frame and pass the parsed message to the handler, in order
+     * @param {string|Blob|ArrayBuffer} payload - event.data from the socket
+     * @param {function} handler - Called with the parsed message
+     */
+    decode(payload, handler) {
+        this.tail = this.tail
+            .then(() => (typeof payload === 'string' ? payload : this.inflate(payload)))
+            .then(text => {
+                const data = JSON.parse(text);
+                if (data.type === 'batch') {
+                    data.messages.forEach(message => handler(message));
+                } else {
+                    handler(data);
+                }
+            })
+            .catch(error => console.error('Failed to decode frame:', error));
+    }
+}
+
+export default FrameDecoder;
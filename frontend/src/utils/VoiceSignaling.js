@@ -0,0 +1,292 @@
+/**
+ * WebRTC signaling for voice chat
+ * Owns one RTCPeerConnection per remote participant (mesh) or a single one
+ * to the relay (hub). Outgoing ICE candidates are coalesced per target into
+ * one voice_ice_candidates frame; incoming batches are unpacked into the
+ * matching peer connection
+ */
+
+const ICE_SERVERS = [{ urls: 'stun:stun.l.google.com:19302' }];
+const MAX_PENDING_PEERS = 16; // Peers we buffer early candidates for
+const MAX_PENDING_CANDIDATES = 64; // Per peer
+
+class VoiceSignaling {
+    constructor(ws, batchWindow = 5) {
+        this.ws = ws;
+        this.batchWindow = batchWindow; // milliseconds
+        this.nickname = null;
+        this.localStream = null; // Set while in a voice session
+        this.topology = 'mesh';
+        this.peers = new Map(); // nickname -> RTCPeerConnection
+        this.remoteAudio = new Map(); // nickname -> Audio element
+        this.pendingRemote = new Map(); // nickname -> candidates received too early
+        this.outgoing = new Map(); // target nickname -> candidates
+        this.flushTimer = null;
+    }
+
+    send(message) {
+        if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+            this.ws.send(JSON.stringify(message));
+        }
+    }
+
+    /**
+     * Join the voice session with a local media stream
+     * @param {string} nickname - Our own nickname
+     * @param {MediaStream} stream - Local microphone stream
+     */
+    join(nickname, stream) {
+        this.nickname = nickname;
+        this.localStream = stream;
+        this.send({ type: 'voice_join' });
+    }
+
+    /**
+     * Leave the voice session and close every peer connection
+     */
+    leave() {
+        if (!this.localStream) return;
+        this.send({ type: 'voice_leave' });
+        this.closeAll();
+        this.localStream = null;
+    }
+
+    /**
+     * Send a new local stream's tracks on the existing connections
+     * @param {MediaStream} stream - Replacement local stream
+     */
+    replaceStream(stream) {
+        if (!this.localStream || stream === this.localStream) return;
+        this.localStream = stream;
+        this.peers.forEach(peerConnection => {
+            peerConnection.getSenders().forEach(sender => {
+                const track = sender.track && stream.getTracks().find(t => t.kind === sender.track.kind);
+                if (track) {
+                    sender.replaceTrack(track).catch(error => {
+                        console.error('Failed to replace track:', error);
+                    });
+                }
+            });
+        });
+    }
+
+    /**
+     * Create and track a peer connection carrying the local stream
+     * @param {string} nickname - Remote participant (or the relay)
+     * @returns {RTCPeerConnection} The new connection
+     */
+    createPeer(nickname) {
+        // Replaces any earlier connection; early candidates stay buffered
+        const previous = this.peers.get(nickname);
+        if (previous) {
+            previous.close();
+        }
+        const peerConnection = new RTCPeerConnection({ iceServers: ICE_SERVERS });
+        this.localStream.getTracks().forEach(track => peerConnection.addTrack(track, this.localStream));
+        peerConnection.onicecandidate = event => this.sendCandidate(nickname, event.candidate);
+        peerConnection.ontrack = event => this.playRemote(nickname, event.streams[0]);
+        this.registerPeer(nickname, peerConnection);
+        return peerConnection;
+    }
+
+    /**
+     * Offer a connection to a participant (or the relay)
+     * @param {string} nickname - Remote participant
+     */
+    async offer(nickname) {
+        try {
+            const peerConnection = this.createPeer(nickname);
+            await peerConnection.setLocalDescription(await peerConnection.createOffer());
+            this.send({ type: 'voice_offer', to: nickname, offer: peerConnection.localDescription });
+        } catch (error) {
+            console.error('Failed to create voice offer:', error);
+        }
+    }
+
+    /**
+     * Track a peer connection and apply any candidates that arrived before it
+     * @param {string} nickname - Remote participant (or the relay)
+     * @param {RTCPeerConnection} peerConnection - Connection to that participant
+     */
+    registerPeer(nickname, peerConnection) {
+        this.peers.set(nickname, peerConnection);
+        this.applyPending(nickname);
+    }
+
+    /**
+     * Stop tracking a peer connection
+     * @param {string} nickname - Remote participant
+     */
+    removePeer(nickname) {
+        this.peers.delete(nickname);
+        this.pendingRemote.delete(nickname);
+        this.outgoing.delete(nickname);
+    }
+
+    closePeer(nickname) {
+        const peerConnection = this.peers.get(nickname);
+        if (peerConnection) {
+            peerConnection.close();
+        }
+        const audio = this.remoteAudio.get(nickname);
+        if (audio) {
+            audio.srcObject = null;
+            this.remoteAudio.delete(nickname);
+        }
+        this.removePeer(nickname);
+    }
+
+    closeAll() {
+        Array.from(this.peers.keys()).forEach(nickname => this.closePeer(nickname));
+        this.pendingRemote.clear();
+    }
+
+    playRemote(nickname, stream) {
+        if (!stream) return;
+        let audio = this.remoteAudio.get(nickname);
+        if (!audio) {
+            audio = new Audio();
+            audio.autoplay = true;
+            this.remoteAudio.set(nickname, audio);
+        }
+        audio.srcObject = stream;
+        audio.play().catch(error => console.error('Failed to play remote audio:', error));
+    }
+
+    /**
+     * Handle a voice_session frame: (re)negotiate for the current topology.
+     * In a mesh the participant with the smaller nickname makes the offer,
+     * so two peers never offer to each other at once
+     * @param {object} data - Frame with topology, relay and participants
+     */
+    handleSession(data) {
+        if (!this.localStream) return;
+        this.topology = data.topology;
+        this.closeAll(); // Connections from the previous topology are stale
+
+        if (data.topology === 'hub') {
+            this.offer(data.relay);
+        } else {
+            data.participants
+                .filter(participant => participant !== this.nickname && this.nickname < participant)
+                .forEach(participant => this.offer(participant));
+        }
+    }
+
+    /**
+     * Handle voice_user_joined: in a mesh, offer if we are the initiator
+     * @param {object} data - Frame with the joining user
+     */
+    handleUserJoined(data) {
+        if (this.localStream && this.topology === 'mesh' && this.nickname < data.user) {
+            this.offer(data.user);
+        }
+    }
+
+    handleUserLeft(data) {
+        this.closePeer(data.user);
+    }
+
+    /**
+     * Answer an offer from a participant (or the relay)
+     * @param {object} data - Frame with from and offer
+     */
+    async handleOffer(data) {
+        if (!this.localStream) return;
+        try {
+            const peerConnection = this.createPeer(data.from);
+            await peerConnection.setRemoteDescription(data.offer);
+            this.applyPending(data.from);
+            await peerConnection.setLocalDescription(await peerConnection.createAnswer());
+            this.send({ type: 'voice_answer', to: data.from, answer: peerConnection.localDescription });
+        } catch (error) {
+            console.error('Failed to answer voice offer:', error);
+        }
+    }
+
+    async handleAnswer(data) {
+        const peerConnection = this.peers.get(data.from);
+        if (!peerConnection) return;
+        try {
+            await peerConnection.setRemoteDescription(data.answer);
+            this.applyPending(data.from);
+        } catch (error) {
+            console.error('Failed to apply voice answer:', error);
+        }
+    }
+
+    /**
+     * Queue a local candidate for a target; call from onicecandidate
+     * @param {string} target - Remote participant
+     * @param {RTCIceCandidate|null} candidate - null marks end-of-candidates
+     */
+    sendCandidate(target, candidate) {
+        if (!this.outgoing.has(target)) {
+            this.outgoing.set(target, []);
+        }
+        this.outgoing.get(target).push(candidate ? candidate.toJSON() : null);
+
+        if (!candidate) {
+            this.flush();
+        } else if (!this.flushTimer) {
+            this.flushTimer = setTimeout(() => this.flush(), this.batchWindow);
+        }
+    }
+
+    /**
+     * Send every queued candidate, one frame per target
+     */
+    flush() {
+        clearTimeout(this.flushTimer);
+        this.flushTimer = null;
+        this.outgoing.forEach((candidates, target) => {
+            this.send({
+                type: 'voice_ice_candidates',
+                to: target,
+                candidates: candidates
+            });
+        });
+        this.outgoing.clear();
+    }
+
+    /**
+     * Handle a voice_ice_candidates frame from the server
+     * @param {object} data - Frame with candidates: [{from, candidate}]
+     */
+    handleCandidates(data) {
+        if (!this.localStream) return; // Not in a voice session
+        (data.candidates || []).forEach(({ from, candidate }) => {
+            // Candidates may beat the offer they belong to; buffer a bounded
+            // number for peers we have no connection to yet
+            if (!this.pendingRemote.has(from)) {
+                if (!this.peers.has(from) && this.pendingRemote.size >= MAX_PENDING_PEERS) return;
+                this.pendingRemote.set(from, []);
+            }
+            const pending = this.pendingRemote.get(from);
+            if (pending.length < MAX_PENDING_CANDIDATES) {
+                pending.push(candidate);
+            }
+            this.applyPending(from);
+        });
+    }
+
+    /**
+     * Add buffered candidates once the peer has a remote description;
+     * call again after setRemoteDescription
+     * @param {string} nickname - Remote participant
+     */
+    applyPending(nickname) {
+        const peerConnection = this.peers.get(nickname);
+        const candidates = this.pendingRemote.get(nickname);
+        if (!peerConnection || !peerConnection.remoteDescription || !candidates) return;
+
+        this.pendingRemote.delete(nickname);
+        candidates.forEach(candidate => {
+            peerConnection.addIceCandidate(candidate || null).catch(error => {
+                console.error('Failed to add ICE candidate:', error);
+            });
+        });
+    }
+}
+
+export default VoiceSignaling;
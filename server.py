@@ -10,6 +10,7 @@ import json
 import logging
 import socket
 import os
+from voice_sessions import VoiceSessionManager
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -19,6 +20,7 @@ class ChatServer:
     def __init__(self):
         self.clients = {}
         self.rooms = {"general": set()}
+        self.voice = VoiceSessionManager(self.send_to_client)
 
     async def handle_client(self, websocket, path):
         client_id = id(websocket)
@@ -48,15 +50,17 @@ class ChatServer:
             elif message_type == 'get_users':
                 await self.send_user_list(client_id)
             elif message_type == 'voice_join':
-                await self.handle_voice_join(client_id, data.get('nickname'))
+                await self.handle_voice_join(client_id)
             elif message_type == 'voice_leave':
-                await self.handle_voice_leave(client_id, data.get('nickname'))
+                await self.handle_voice_leave(client_id)
             elif message_type == 'voice_offer':
                 await self.relay_voice_message(client_id, data)
             elif message_type == 'voice_answer':
                 await self.relay_voice_message(client_id, data)
             elif message_type == 'voice_ice_candidate':
                 await self.relay_voice_message(client_id, data)
+            elif message_type == 'voice_ice_candidates':
+                await self.relay_voice_message(client_id, data)
                 
         except json.JSONDecodeError:
             logger.error(f"Invalid JSON from client {client_id}")
@@ -99,51 +103,20 @@ class ChatServer:
             if self.clients[client_id]['room'] == room:
                 await self.send_to_client(client_id, chat_message)
 
-    async def handle_voice_join(self, client_id, nickname):
-        if client_id in self.clients:
-            # Notify other users that someone joined voice chat
-            join_message = {
-                'type': 'voice_user_joined',
-                'user': nickname
-            }
-            
-            # Send to all other clients in the same room
-            room = self.clients[client_id]['room']
-            for other_client_id in list(self.clients.keys()):
-                if (other_client_id != client_id and 
-                    self.clients[other_client_id]['room'] == room):
-                    await self.send_to_client(other_client_id, join_message)
-
-    async def handle_voice_leave(self, client_id, nickname):
+    async def handle_voice_join(self, client_id):
         if client_id in self.clients:
-            # Notify other users that someone left voice chat
-            leave_message = {
-                'type': 'voice_user_left',
-                'user': nickname
-            }
-            
-            # Send to all other clients in the same room
-            room = self.clients[client_id]['room']
-            for other_client_id in list(self.clients.keys()):
-                if (other_client_id != client_id and 
-                    self.clients[other_client_id]['room'] == room):
-                    await self.send_to_client(other_client_id, leave_message)
+            client = self.clients[client_id]
+            if client['nickname']:
+                await self.voice.join(client_id, client['nickname'], client['room'])
+
+    async def handle_voice_leave(self, client_id):
+        await self.voice.leave(client_id)
 
     async def relay_voice_message(self, sender_id, data):
-        # Relay WebRTC signaling messages between users
-        target_nickname = data.get('to')
-        if not target_nickname:
+        # Relay WebRTC signaling messages between voice participants
+        if not data.get('to'):
             return
-            
-        # Find the target client
-        target_client_id = None
-        for client_id, client in self.clients.items():
-            if client['nickname'] == target_nickname:
-                target_client_id = client_id
-                break
-        
-        if target_client_id:
-            await self.send_to_client(target_client_id, data)
+        await self.voice.relay_signal(sender_id, data)
 
     async def broadcast_to_all(self, message):
         for client_id in list(self.clients.keys()):
@@ -177,6 +150,7 @@ class ChatServer:
         if client_id in self.clients:
             nickname = self.clients[client_id]['nickname']
             del self.clients[client_id]
+            await self.voice.leave(client_id)
             
             # Send leave notification if user had a nickname
             if nickname:
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Voice Sessions
+Tracks voice participants per room and routes WebRTC signaling between them.
+
+Small calls use a full mesh (every participant connects to every other).
+Once a call grows past the mesh limit it switches to a hub topology, where
+each participant holds a single peer connection to a relay peer. Without a
+relay configured, calls stay in mesh and are capped at the mesh limit.
+"""
+
+import abc
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+MESH_LIMIT = int(os.environ.get('VOICE_MESH_LIMIT', 4))
+MAX_PARTICIPANTS = int(os.environ.get('VOICE_MAX_PARTICIPANTS', 16))
+ICE_BATCH_WINDOW = float(os.environ.get('VOICE_ICE_BATCH_WINDOW', 0.005))  # seconds
+
+RELAY_NICKNAME = '__relay__'
+
+
+def is_end_of_candidates(candidate):
+    """Trickle ICE signals the end with a null or empty candidate"""
+    if isinstance(candidate, dict):
+        return not candidate.get('candidate')
+    return not candidate
+
+
+class RelayPeer(abc.ABC):
+    """The hub end of every peer connection in hub topology.
+
+    A real deployment plugs in a media relay (SFU) here. ``send`` is an
+    async callable ``send(client_id, message)`` for replying to participants.
+    """
+
+    def __init__(self, room, send):
+        self.room = room
+        self.send = send
+
+    async def attach(self, client_id, nickname):
+        pass
+
+    async def detach(self, client_id):
+        pass
+
+    @abc.abstractmethod
+    async def handle_signal(self, client_id, data):
+        """Handle an offer or ICE candidates a participant sent to the relay"""
+
+    async def close(self):
+        pass
+
+
+class LoopbackRelayPeer(RelayPeer):
+    """Stand-in relay that answers offers with the offered SDP.
+
+    For the benchmark self-check and tests only: it completes the signaling
+    exchange without any media stack and records what it received. A
+    browser rejects the echoed offer as an answer, so never deploy it.
+    """
+
+    def __init__(self, room, send):
+        super().__init__(room, send)
+        self.attached = {}
+        self.candidates = {}
+
+    async def attach(self, client_id, nickname):
+        self.attached[client_id] = nickname
+        self.candidates.setdefault(client_id, [])
+
+    async def detach(self, client_id):
+        self.attached.pop(client_id, None)
+        self.candidates.pop(client_id, None)
+
+    async def handle_signal(self, client_id, data):
+        message_type = data.get('type')
+        if message_type == 'voice_offer':
+            await self.send(client_id, {
+                'type': 'voice_answer',
+                'from': RELAY_NICKNAME,
+                'to': self.attached.get(client_id),
+                'answer': data.get('offer')
+            })
+        elif message_type == 'voice_ice_candidates':
+            self.candidates.setdefault(client_id, []).extend(data.get('candidates', []))
+
+
+class VoiceRoom:
+    def __init__(self, name):
+        self.name = name
+        self.participants = {}  # client_id -> nickname, in join order
+        self.topology = 'mesh'
+        self.relay = None
+
+
+class VoiceSessionManager:
+    """Voice participant index and signaling router.
+
+    ``send`` is an async callable ``send(client_id, message)`` provided by
+    the chat server. ``relay_factory(room_name, send)`` builds the relay for
+    hub topology; with None, a room never grows past the mesh limit.
+    """
+
+    def __init__(self, send, relay_factory=None, mesh_limit=MESH_LIMIT,
+                 max_participants=MAX_PARTICIPANTS, batch_window=ICE_BATCH_WINDOW):
+        self.send = send
+        self.relay_factory = relay_factory
+        self.mesh_limit = mesh_limit
+        self.max_participants = max_participants
+        self.batch_window = batch_window
+
+        self.rooms = {}  # room name -> VoiceRoom
+        self.participant_rooms = {}  # client_id -> room name
+
+        # ICE candidates waiting to be coalesced, per target client
+        self.pending_candidates = {}
+        self.flush_handles = {}
+        self.stats = {'candidates': 0, 'frames': 0}
+
+    def get_room(self, client_id):
+        room_name = self.participant_rooms.get(client_id)
+        return self.rooms.get(room_name) if room_name else None
+
+    async def join(self, client_id, nickname, room_name):
+        """Admit a client into a room's voice session"""
+        if client_id in self.participant_rooms:
+            await self.leave(client_id)
+
+        room = self.rooms.setdefault(room_name, VoiceRoom(room_name))
+        max_participants = self.max_participants if self.relay_factory else self.mesh_limit
+        if len(room.participants) >= max_participants:
+            await self.send(client_id, {
+                'type': 'voice_join_rejected',
+                'reason': 'Voice chat is full',
+                'max_participants': max_participants
+            })
+            if not room.participants:
+                del self.rooms[room_name]
+            return False
+
+        room.participants[client_id] = nickname
+        self.participant_rooms[client_id] = room_name
+        logger.info(f"{nickname} joined voice in {room_name} ({len(room.participants)} participants)")
+
+        if room.topology == 'mesh' and len(room.participants) > self.mesh_limit:
+            # Tells every participant, the new one included
+            await self.switch_topology(room, 'hub')
+        else:
+            if room.topology == 'hub':
+                await room.relay.attach(client_id, nickname)
+            await self.send(client_id, self.session_message(room))
+
+        # Only voice participants need to hear about it, not the whole room
+        await self.send_to_participants(room, {
+            'type': 'voice_user_joined',
+            'user': nickname
+        }, exclude=client_id)
+        return True
+
+    async def leave(self, client_id):
+        """Remove a client from its voice session, if any"""
+        room = self.get_room(client_id)
+        if not room:
+            return
+
+        self.cancel_candidates(client_id)
+        nickname = room.participants.pop(client_id)
+        del self.participant_rooms[client_id]
+        logger.info(f"{nickname} left voice in {room.name} ({len(room.participants)} participants)")
+
+        if room.relay:
+            await room.relay.detach(client_id)
+
+        if not room.participants:
+            if room.relay:
+                await room.relay.close()
+            del self.rooms[room.name]
+            return
+
+        await self.send_to_participants(room, {
+            'type': 'voice_user_left',
+            'user': nickname
+        })
+
+        if room.topology == 'hub' and len(room.participants) <= self.mesh_limit:
+            await self.switch_topology(room, 'mesh')
+
+    async def switch_topology(self, room, topology):
+        """Move every participant in a room to a new topology"""
+        logger.info(f"Voice in {room.name} switching from {room.topology} to {topology}")
+        room.topology = topology
+
+        if topology == 'hub':
+            room.relay = self.relay_factory(room.name, self.send)
+            for client_id, nickname in room.participants.items():
+                await room.relay.attach(client_id, nickname)
+        else:
+            await room.relay.close()
+            room.relay = None
+
+        # Existing peer connections are stale; clients renegotiate on this
+        for client_id in list(room.participants):
+            self.cancel_candidates(client_id)
+            await self.send(client_id, self.session_message(room))
+
+    def session_message(self, room):
+        return {
+            'type': 'voice_session',
+            'topology': room.topology,
+            'relay': RELAY_NICKNAME if room.topology == 'hub' else None,
+            'participants': list(room.participants.values())
+        }
+
+    async def send_to_participants(self, room, message, exclude=None):
+        for client_id in list(room.participants):
+            if client_id != exclude:
+                await self.send(client_id, message)
+
+    async def relay_signal(self, sender_id, data):
+        """Route an offer, answer or ICE candidate(s) to its target"""
+        room = self.get_room(sender_id)
+        if not room:
+            return
+
+        message = dict(data)
+        message['from'] = room.participants[sender_id]
+        target_nickname = message.get('to')
+
+        if message['type'] == 'voice_ice_candidate':
+            candidates = [message.get('candidate')]
+        elif message['type'] == 'voice_ice_candidates':
+            candidates = list(message.get('candidates') or [])
+        else:
+            candidates = None
+
+        if room.topology == 'hub':
+            # Every peer connection terminates at the in-process relay, so
+            # there are no frames to save by batching
+            if candidates is not None:
+                await room.relay.handle_signal(sender_id, {
+                    'type': 'voice_ice_candidates',
+                    'from': message['from'],
+                    'candidates': candidates
+                })
+            else:
+                await room.relay.handle_signal(sender_id, message)
+            return
+
+        target_id = None
+        for client_id, nickname in room.participants.items():
+            if nickname == target_nickname and client_id != sender_id:
+                target_id = client_id
+                break
+        if target_id is None:
+            return
+
+        if candidates is not None:
+            await self.queue_candidates(target_id, message['from'], candidates)
+        else:
+            # Keep ordering: candidates queued earlier for this target go first
+            await self.flush_candidates(target_id)
+            await self.send(target_id, message)
+
+    async def queue_candidates(self, target_id, sender_nickname, candidates):
+        """Coalesce candidates bound for one target, from any sender"""
+        batch = self.pending_candidates.setdefault(target_id, [])
+        batch.extend({'from': sender_nickname, 'candidate': candidate} for candidate in candidates)
+        self.stats['candidates'] += len(candidates)
+
+        # An empty candidate marks end-of-candidates: nothing more is coming
+        # from this sender, so don't hold the batch for the rest of the window
+        if self.batch_window <= 0 or any(is_end_of_candidates(c) for c in candidates):
+            await self.flush_candidates(target_id)
+        elif target_id not in self.flush_handles:
+            loop = asyncio.get_running_loop()
+            self.flush_handles[target_id] = loop.call_later(
+                self.batch_window,
+                lambda: asyncio.ensure_future(self.flush_candidates(target_id))
+            )
+
+    async def flush_candidates(self, target_id):
+        """Send a target's pending candidates as one frame"""
+        handle = self.flush_handles.pop(target_id, None)
+        if handle:
+            handle.cancel()
+        batch = self.pending_candidates.pop(target_id, None)
+        if not batch:
+            return
+
+        room = self.get_room(target_id)
+        self.stats['frames'] += 1
+        await self.send(target_id, {
+            'type': 'voice_ice_candidates',
+            'to': room.participants.get(target_id) if room else None,
+            'candidates': batch
+        })
+
+    def cancel_candidates(self, client_id):
+        """Drop pending candidates to or from a client"""
+        handle = self.flush_handles.pop(client_id, None)
+        if handle:
+            handle.cancel()
+        self.pending_candidates.pop(client_id, None)
+
+        room = self.get_room(client_id)
+        nickname = room.participants.get(client_id) if room else None
+        if nickname is None:
+            return
+        for target_id, batch in list(self.pending_candidates.items()):
+            batch[:] = [entry for entry in batch if entry['from'] != nickname]